@@ -10,6 +10,8 @@
 
 import sys
 import os
+import asyncio
+import re
 import fcntl
 import array
 import threading
@@ -18,54 +20,527 @@ import termios
 import pty
 import signal
 import struct
-import select
+import selectors
 import subprocess
+import weakref
+import zlib
+import mmap
+import tempfile
 
+import bisect
+import codecs
 import collections
-import itertools
 
+import charwidth
 
-__version__ = "0.1"
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class History(collections.deque):
-    def __init__(self, maxlen=500):
-        super().__init__([], maxlen)
 
-    def write_line(self, line):
-        self.appendleft(line)
+__version__ = "0.1"
+
+# Characters that pass straight through vt100_write and dumb_write to
+# dumb_echo when no control sequence is being parsed: printable characters
+# without the C1 controls and surrogates.
+PRINTABLE_RUN = re.compile('[\x20-\x7f\xa0-\ud7ff\ue000-\U0010ffff]+')
+# Characters ignored inside control strings
+STRING_BODY = re.compile('[\x20-\x7f\xa0-\U0010ffff]+')
+
+# A screen cell is an unsigned 32 bit int holding the character in the low
+# 21 bits and the index of its style in the terminal's StylePalette above
+CELL_CHAR = 0x1fffff
+CELL_STYLE_SHIFT = 21
+# Cells are built from and decoded to UTF-32 in bulk. CELL_BYTE1 to
+# CELL_BYTE3 are the offsets of bits 8-15, 16-23 and 24-31 of a cell, byte 2
+# is shared by the character and the style.
+CELL_CODEC = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
+CELL_BYTE1, CELL_BYTE2, CELL_BYTE3 = (
+    (1, 2, 3) if sys.byteorder == 'little' else (2, 1, 0))
+CELL_BYTE2_CHAR = bytes(b & 0x1f for b in range(256))
+CELL_BYTE2_STYLE = bytes(b >> 5 for b in range(256))
+CELL_BYTE2_WITH_STYLE = [bytes(b | (k << 5) for b in range(256))
+                         for k in range(8)]
+# Runs of equal two byte style indexes
+STYLE_RUN = re.compile(b'(..)\\1*', re.DOTALL)
+# Characters below U+0300 are all one column wide, so a span of cells whose
+# character bytes above the first are all below 0x03 can skip the width
+# check
+SPECIAL_MIN_HIGH_BYTE = 0x03
+
+# Style flags
+(STYLE_BOLD, STYLE_FAINT, STYLE_ITALIC, STYLE_UNDERLINE, STYLE_BLINK,
+ STYLE_INVERSE, STYLE_CONCEAL, STYLE_STRIKE) = (1 << i for i in range(8))
+# SGR parameters setting and resetting flags
+SGR_SET_FLAGS = {
+    1: STYLE_BOLD, 2: STYLE_FAINT, 3: STYLE_ITALIC, 4: STYLE_UNDERLINE,
+    5: STYLE_BLINK, 6: STYLE_BLINK, 7: STYLE_INVERSE, 8: STYLE_CONCEAL,
+    9: STYLE_STRIKE, 21: STYLE_UNDERLINE}
+SGR_RESET_FLAGS = {
+    22: STYLE_BOLD | STYLE_FAINT, 23: STYLE_ITALIC, 24: STYLE_UNDERLINE,
+    25: STYLE_BLINK, 27: STYLE_INVERSE, 28: STYLE_CONCEAL, 29: STYLE_STRIKE}
+
+# A color is None for the default color, an index into the 256 color
+# palette or an (r, g, b) tuple
+Style = collections.namedtuple('Style', 'fg bg flags')
+DEFAULT_STYLE = Style(None, None, 0)
+# Style of a run of text in dump, reverse video is already applied to the
+# flags and cursor is set for the cell under the cursor
+DumpStyle = collections.namedtuple('DumpStyle', 'fg bg ul flags cursor')
+
+# RGB values of the 256 color palette
+XTERM_COLORS = [
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238),
+    (205, 0, 205), (0, 205, 205), (229, 229, 229), (127, 127, 127),
+    (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255), (255, 0, 255),
+    (0, 255, 255), (255, 255, 255)] + [
+    (r and r * 40 + 55, g and g * 40 + 55, b and b * 40 + 55)
+    for r in range(6) for g in range(6) for b in range(6)] + [
+    (8 + 10 * i,) * 3 for i in range(24)]
+
+# VT100 parser actions
+(VT100_PRINT, VT100_IGNORE, VT100_ESC, VT100_C1, VT100_CANCEL, VT100_SO,
+ VT100_SI, VT100_FINAL, VT100_PARAM, VT100_SEPARATOR, VT100_PREFIX,
+ VT100_INTERMEDIATE, VT100_MALFORMED) = range(13)
+
+
+def vt100_action_table(state):
+    # Action for every character below 0xa0 in the given parser state, the
+    # last entry applies to all characters from 0xa0 on
+    table = bytearray([VT100_PRINT] * 0xa1)
+    if state == 'str':
+        table[0x20:] = [VT100_IGNORE] * (0xa1 - 0x20)
+    elif state:
+        table[0x20:0x30] = [VT100_INTERMEDIATE] * 0x10
+        table[0x30:] = [VT100_FINAL] * (0xa1 - 0x30)
+        if state == 'csi':
+            table[0x30:0x3a] = [VT100_PARAM] * 10
+            table[0x3a:0x40] = [VT100_PREFIX] * 6
+            table[0x3b] = VT100_SEPARATOR
+        elif state == 'csi_int':
+            table[0x30:0x40] = [VT100_MALFORMED] * 0x10
+        table[24] = table[26] = VT100_CANCEL
+    table[14] = VT100_SO
+    table[15] = VT100_SI
+    table[27] = VT100_ESC
+    table[0x80:0xa0] = [VT100_C1] * 0x20
+    return bytes(table)
+
+
+# Parser states: ground, escape, CSI parameters, intermediate bytes of an
+# escape or CSI sequence and control strings
+VT100_ACTIONS = dict((state, vt100_action_table(state)) for state in
+                     ('', 'esc', 'esc_int', 'csi', 'csi_int', 'str'))
+VT100_INTERMEDIATE_STATE = {
+    'esc': 'esc_int',
+    'esc_int': 'esc_int',
+    'csi': 'csi_int',
+    'csi_int': 'csi_int',
+}
+
+def cells_text(data):
+    # Characters of the cells in a bytes-like object, one per cell
+    data = bytearray(data)
+    data[CELL_BYTE3::4] = bytes(len(data) // 4)
+    data[CELL_BYTE2::4] = data[CELL_BYTE2::4].translate(CELL_BYTE2_CHAR)
+    return data.decode(CELL_CODEC, 'surrogatepass')
+
+
+def color_distance(a, b):
+    if a is None or b is None:
+        return 0 if a is b else 1 << 18
+    if not isinstance(a, tuple):
+        a = XTERM_COLORS[a]
+    if not isinstance(b, tuple):
+        b = XTERM_COLORS[b]
+    return sum((i - j) * (i - j) for i, j in zip(a, b))
+
+
+def style_distance(a, b):
+    # How different two styles look, flags count more than any color
+    distance = color_distance(a.fg, b.fg) + color_distance(a.bg, b.bg)
+    if a.flags != b.flags:
+        distance += 1 << 20
+    return distance
+
+
+def row_text(row):
+    # Characters of a row of cells, without trailing blanks
+    return cells_text(row.tobytes()).rstrip()
+
+
+def search_rows(pattern, text):
+    # Matches in newline separated rows as (row, column), first row first
+    row = 0
+    pos = 0
+    for match in pattern.finditer(text):
+        start = match.start()
+        row += text.count('\n', pos, start)
+        pos = start
+        yield row, start - text.rfind('\n', 0, start) - 1
+
+
+class HistorySegment(object):
+    # Rows frozen into one zlib compressed block, oldest row first, and
+    # their text kept uncompressed for searching
+    __slots__ = ('lengths', 'data', 'text')
+
+    def __init__(self, rows, texts):
+        self.lengths = array.array('H', [len(row) for row in rows])
+        self.data = zlib.compress(b''.join(row.tobytes() for row in rows), 1)
+        self.text = '\n'.join(texts)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def nbytes(self):
+        return (len(self.data) + self.lengths.itemsize * len(self.lengths) +
+                len(self.text))
+
+    def thaw(self):
+        cells = array.array('I', zlib.decompress(self.data))
+        rows = []
+        pos = 0
+        for n in self.lengths:
+            rows.append(cells[pos:pos + n])
+            pos += n
+        return rows
+
+
+class HistorySpill(object):
+    # Rows that no longer fit in memory, in a temporary file of fixed size
+    # records used as a ring buffer, index 0 is the oldest row. Rows are
+    # read back as memoryviews of the file mapping, without copying.
+    def __init__(self, max_bytes, width=256, directory=None):
+        self.width = width
+        self.capacity = max(1, max_bytes // (width * 4))
+        self.file = tempfile.TemporaryFile(prefix='pymux-', dir=directory)
+        self.file.truncate(self.capacity * width * 4)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.cells = memoryview(self.map).cast('I')
+        self.lengths = array.array('H', bytes(2 * self.capacity))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        # Memory used, the rows themselves are on disk
+        return self.lengths.itemsize * self.capacity
+
+    def append(self, rows):
+        # Rows oldest first, overwriting the oldest rows when full
+        width = self.width
+        for row in rows:
+            slot = (self.start + self.count) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            else:
+                self.start = (self.start + 1) % self.capacity
+            n = min(len(row), width)
+            pos = slot * width
+            self.cells[pos:pos + n] = memoryview(row)[:n]
+            self.lengths[slot] = n
 
     def __getitem__(self, index):
-        if isinstance(index, slice):
-            return itertools.islice(self, index.start, index.stop, index.step)
-        return collections.deque.__getitem__(self, index)
-
-    def scrollback(self, lines, terminal_height):
-        lenght = len(self)
-        if lines >= lenght:
-            #raise ValueError('{}: scrollback exceeds maxlen'.format(self))
-            lines = lenght
-        end = lines-terminal_height
-        if end < 0:
-            end = 0
-        result = self[end:lines]
-        return result
+        slot = (self.start + index) % self.capacity
+        pos = slot * self.width
+        return self.cells[pos:pos + self.lengths[slot]]
+
+    def search(self, pattern, chunk=1024):
+        # Matches as (index, column), most recent first. Rows are decoded
+        # a chunk of consecutive records at a time.
+        width = self.width
+        end = self.count
+        while end > 0:
+            # Consecutive records up to end, without wrapping around
+            last = (self.start + end - 1) % self.capacity
+            n = min(end, chunk, last + 1)
+            begin = end - n
+            slot = last - n + 1
+            text = cells_text(self.map[slot * width * 4:
+                                       (slot + n) * width * 4])
+            rows = [text[i * width:i * width + self.lengths[slot + i]].rstrip()
+                    for i in range(n)]
+            matches = list(search_rows(pattern, '\n'.join(rows)))
+            matches.sort(key=lambda match: -match[0])
+            for row, x in matches:
+                yield begin + row, x
+            end = begin
 
-    def join_to_screen(self, screen, h, scrollback):
-        result = array.array('i', [])
-        for line in self.scrollback(scrollback, h):
-            result = line + result
-                
-        if len(result) < len(screen):
-            result = result+screen[:len(screen)-len(result)]   
+    def close(self):
+        self.cells.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Rows are still referenced, the mapping goes when they do
+            pass
+        self.file.close()
+
+
+class History(object):
+    # Scrollback rows, index 0 is the most recent row. New rows are kept as
+    # they are, older ones are frozen into compressed segments of
+    # segment_lines rows which are decompressed again when they are read.
+    # The text of every row is indexed when it is written, for search.
+    # With spill_bytes set, rows evicted from memory go to a HistorySpill
+    # of that size instead of being dropped.
+    # Memory is limited per history by max_bytes and for all histories
+    # together by History.max_total_bytes, the oldest rows go first. The
+    # total is shared by all multiplexers of the process, set it with
+    # History.set_total_budget.
+    # The lock lets readers view the rows while the terminal writes.
+    max_total_bytes = 64 << 20
+    instances = weakref.WeakSet()
+    instances_lock = threading.Lock()
+
+    def __init__(self, max_bytes=4 << 20, segment_lines=256, spill_bytes=0,
+                 spill_dir=None):
+        self.max_bytes = max_bytes
+        self.segment_lines = segment_lines
+        self.lock = threading.RLock()
+        # Rows written so far
+        self.written = 0
+        # Uncompressed rows, oldest first
+        self.hot = []
+        self.hot_text = []
+        self.hot_bytes = 0
+        # Compressed segments, oldest first
+        self.segments = collections.deque()
+        self.cold_bytes = 0
+        # Recently decompressed segments
+        self.thawed = collections.OrderedDict()
+        # Rows evicted from memory, oldest first
+        self.spill = None
+        if spill_bytes:
+            self.spill = HistorySpill(spill_bytes, directory=spill_dir)
+        with History.instances_lock:
+            History.instances.add(self)
 
-        return result
+    @classmethod
+    def set_total_budget(cls, max_bytes):
+        cls.max_total_bytes = max_bytes
+
+    @classmethod
+    def total_bytes(cls):
+        with cls.instances_lock:
+            return sum(history.nbytes() for history in cls.instances)
+
+    @classmethod
+    def enforce_total_budget(cls):
+        # Evict from the largest history until all fit in max_total_bytes.
+        # Called without any history lock held, the lock of one history is
+        # taken at a time so writers of two histories cannot deadlock.
+        total = cls.total_bytes()
+        while total > cls.max_total_bytes:
+            with cls.instances_lock:
+                history = max(cls.instances, key=cls.nbytes)
+            with history.lock:
+                freed = history.nbytes()
+                if not history.evict():
+                    break
+                total -= freed - history.nbytes()
+
+    def nbytes(self):
+        return self.hot_bytes + self.cold_bytes
+
+    def __len__(self):
+        return self.memory_lines() + (len(self.spill) if self.spill else 0)
+
+    def memory_lines(self):
+        return len(self.hot) + len(self.segments) * self.segment_lines
+
+    def write_line(self, line):
+        self.write_lines([line])
+
+    def write_lines(self, lines):
+        # Lines in screen order, the last one is the most recent
+        texts = [row_text(line) for line in lines]
+        with self.lock:
+            self.hot.extend(lines)
+            self.hot_text.extend(texts)
+            self.hot_bytes += (sum(len(line) for line in lines) * 4 +
+                               sum(len(text) for text in texts))
+            self.written += len(lines)
+            frozen = len(self.hot) >= 2 * self.segment_lines
+            while len(self.hot) >= 2 * self.segment_lines:
+                self.freeze()
+            while self.nbytes() > self.max_bytes and self.evict():
+                pass
+        if frozen:
+            History.enforce_total_budget()
+
+    def freeze(self):
+        # Compress the oldest hot rows into a new segment
+        n = self.segment_lines
+        rows = self.hot[:n]
+        texts = self.hot_text[:n]
+        del self.hot[:n]
+        del self.hot_text[:n]
+        self.hot_bytes -= (sum(len(row) for row in rows) * 4 +
+                           sum(len(text) for text in texts))
+        segment = HistorySegment(rows, texts)
+        self.segments.append(segment)
+        self.cold_bytes += segment.nbytes()
+
+    def evict(self):
+        # Drop the oldest segment, or the oldest row if there is none, and
+        # spill the rows to disk
+        if self.segments:
+            segment = self.segments.popleft()
+            self.cold_bytes -= segment.nbytes()
+            rows = self.thawed.pop(segment, None)
+            if self.spill is not None:
+                self.spill.append(rows or segment.thaw())
+        elif self.hot:
+            row = self.hot.pop(0)
+            self.hot_bytes -= len(row) * 4 + len(self.hot_text.pop(0))
+            if self.spill is not None:
+                self.spill.append([row])
+        else:
+            return False
+        return True
 
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    def thaw(self, segment):
+        try:
+            rows = self.thawed[segment]
+            self.thawed.move_to_end(segment)
+        except KeyError:
+            rows = self.thawed[segment] = segment.thaw()
+            if len(self.thawed) > 4:
+                self.thawed.popitem(last=False)
+        return rows
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('history index out of range')
+        if index < len(self.hot):
+            return self.hot[-1 - index]
+        if index >= self.memory_lines():
+            return self.spill[len(self) - 1 - index]
+        segment, row = divmod(index - len(self.hot), self.segment_lines)
+        rows = self.thaw(self.segments[-1 - segment])
+        return rows[-1 - row]
+
+    def search(self, pattern):
+        # Matches of a compiled pattern as (index, column), most recent first
+        for index in range(len(self.hot)):
+            text = self.hot_text[-1 - index]
+            for match in pattern.finditer(text):
+                yield index, match.start()
+        index = len(self.hot)
+        for segment in reversed(self.segments):
+            # Rows of a segment are oldest first, matches within a row are
+            # kept in column order
+            matches = list(search_rows(pattern, segment.text))
+            matches.sort(key=lambda match: -match[0])
+            last = len(segment) - 1
+            for row, x in matches:
+                yield index + last - row, x
+            index += len(segment)
+        if self.spill is not None:
+            last = len(self) - 1
+            for row, x in self.spill.search(pattern):
+                yield last - row, x
+
+    def view(self, lines, h, newer=0):
+        # Up to h rows ending lines rows back, oldest first, as seen before
+        # the newer most recent rows were written
+        with self.lock:
+            lines = min(lines + newer, len(self))
+            end = max(newer, lines - h)
+            return [self[i] for i in range(lines - 1, end - 1, -1)]
+
+
+
+class SequenceCache(collections.OrderedDict):
+    # Bounded LRU cache for parsed control sequences, with hit and miss
+    # counters to size it for a workload
+    def __init__(self, maxsize=512):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, key, value):
+        self[key] = value
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+        return value
+
+
+
+class StylePalette(object):
+    # Styles interned per terminal, cells refer to them by index. Once all
+    # max_styles indexes are taken a new style gets the index of the most
+    # similar one.
+    max_styles = 1 << (32 - CELL_STYLE_SHIFT)
+
+    def __init__(self):
+        self.styles = [DEFAULT_STYLE]
+        self.index = {DEFAULT_STYLE: 0}
+        self.nearest = SequenceCache(1024)
+
+    def __len__(self):
+        return len(self.styles)
+
+    def __getitem__(self, sid):
+        return self.styles[sid]
+
+    def intern(self, style):
+        sid = self.index.get(style)
+        if sid is not None:
+            return sid
+        if len(self.styles) < self.max_styles:
+            sid = self.index[style] = len(self.styles)
+            self.styles.append(style)
+            return sid
+        sid = self.nearest.get(style)
+        if sid is None:
+            styles = self.styles
+            sid = self.nearest.store(style, min(
+                range(len(styles)),
+                key=lambda i: style_distance(style, styles[i])))
+        return sid
+
+
+# Screen state published by Terminal.write for readers: rows as bytes of
+# cells, the generation of each row, the cursor as (x, y, visible) and the
+# number of screen resets
+ScreenSnapshot = collections.namedtuple(
+    'ScreenSnapshot',
+    'generation w h rows row_gen cursor inverse history_written resets')
 
 
 class Terminal(object):
-    def __init__(self, w, h):
+    def __init__(self, w, h, sequence_cache_size=512, history_bytes=4 << 20,
+                 history_spill_bytes=0, history_spill_dir=None):
         self.w = w
         self.h = h
+        # Parsed CSI sequences and parameters, see vt100_parse_process
+        self.vt100_cache = SequenceCache(sequence_cache_size)
+        self.vt100_parse_entry = None
+        # UTF-8 decoder for the output stream, it keeps the incomplete
+        # sequence at the end of a chunk for the next write
+        self.utf8_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # Incremented on every change of the screen, row_gen holds the
+        # generation of the last change of each row
+        self.generation = 0
+        # Incremented by reset_screen, readers drop their dump caches
+        self.resets = 0
+        # Full screen scrolls deferred by write, see scroll_defer
+        self.scroll_coalesce = False
+        self.scroll_pending = 0
         self.vt100_charset_graph = [
             0x25ca, 0x2026, 0x2022, 0x3f,
             0xb6, 0x3f, 0xb0, 0xb1,
@@ -76,6 +551,8 @@ class Terminal(object):
             0x7c, 0x2264, 0x2265, 0xb6,
             0x2260, 0xa3, 0xb7, 0x7f
         ]
+        self.vt100_charset_graph_table = dict(
+            (0x60 + i, c) for i, c in enumerate(self.vt100_charset_graph))
         self.vt100_esc = {
             '#8':	self.esc_DECALN,
             '(A':	self.esc_G0_0,
@@ -197,31 +674,36 @@ class Terminal(object):
             'k':'\x1b[23~',
             'l':'\x1b[24~',
         }
-        self.history = History()
+        self.history = History(history_bytes, spill_bytes=history_spill_bytes,
+                               spill_dir=history_spill_dir)
+        # Styles used by cells on the screen and in the history
+        self.palette = StylePalette()
+        # Readers dump the published snapshot, the dump caches belong to
+        # them and are guarded by dump_lock which write never takes
+        self.snapshot = None
+        self.dump_lock = threading.Lock()
+        self.dump_mode = None
+        self.dumping = None
+        self.dump_styles = {}
+        # Dumped snapshot rows by row number, with their generation
+        self.dump_rows = {}
+        # Dumped rows by content
+        self.dump_cache = SequenceCache(1024)
+        # Style index after an SGR sequence, by previous index and params
+        self.sgr_cache = SequenceCache(256)
         self.reset_hard()
+        self.publish()
 
     # Reset functions
     def reset_hard(self):
-        # Attribute mask: 0x0XFB0000
-        #	X:	Bit 0 - Underlined
-        #		Bit 1 - Negative
-        #		Bit 2 - Concealed
-        #	F:	Foreground
-        #	B:	Background
-        self.attr = 0x00fe0000
-        # UTF-8 decoder
-        self.utf8_units_count = 0
-        self.utf8_units_received = 0
-        self.utf8_char = 0
+        # Style index of new cells, shifted into place
+        self.attr = 0
         # Key filter
         self.vt100_keyfilter_escape = False
         # Last char
         self.vt100_lastchar = 0
         # Control sequences
-        self.vt100_parse_len = 0
-        self.vt100_parse_state = ""
-        self.vt100_parse_func = ""
-        self.vt100_parse_param = ""
+        self.vt100_parse_reset()
         # Buffers
         self.vt100_out = ""
         # Invoke other resets
@@ -229,13 +711,8 @@ class Terminal(object):
         self.reset_soft()
 
     def reset_soft(self):
-        # Attribute mask: 0x0XFB0000
-        #	X:	Bit 0 - Underlined
-        #		Bit 1 - Negative
-        #		Bit 2 - Concealed
-        #	F:	Foreground
-        #	B:	Background
-        self.attr = 0x00fe0000
+        # Style index of new cells, shifted into place
+        self.attr = 0
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
@@ -263,8 +740,13 @@ class Terminal(object):
 
     def reset_screen(self):
         # Screen
-        self.screen = array.array('i', [self.attr | 0x20] * self.w * self.h)
-        self.screen2 = array.array('i', [self.attr | 0x20] * self.w * self.h)
+        self.screen = self.blank_screen()
+        self.screen2 = self.blank_screen()
+        # Per-row sorted columns of double width and of zero width
+        # characters, so the display width left of the cursor is known
+        # without scanning the row
+        self.width_cols = [([], []) for y in range(self.h)]
+        self.width_cols2 = [([], []) for y in range(self.h)]
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
@@ -273,6 +755,11 @@ class Terminal(object):
         self.cy = 0
         # Tab stops
         self.tab_stops = list(range(0, self.w, 8))
+        # Change tracking
+        self.generation += 1
+        self.row_gen = [self.generation] * self.h
+        self.cursor_state = None
+        self.resets += 1
 
 
     # UTF-8 functions
@@ -280,24 +767,105 @@ class Terminal(object):
         return d.decode("utf-8")
 
     def utf8_charwidth(self, char):
-        if char >= 0x2e80:
-            return 2
-        else:
-            return 1
+        return charwidth.char_width(char)
 
     # Low-level terminal functions
-    def peek(self, y0, x0, y1, x1):
-        return self.screen[self.w * y0 + x0:self.w * (y1 - 1) + x1]
+    #
+    # The screen is a list of rows, each an array of cells. The list maps
+    # screen lines to row buffers, so scrolling only moves row references
+    # and allocates the blank rows that scroll in.
+    def blank_row(self):
+        return array.array('I', [self.attr | 0x20]) * self.w
+
+
+    def blank_screen(self):
+        return [self.blank_row() for y in range(self.h)]
+
+
+    def grow_screen(self):
+        # Add a blank row below the screen, for scroll_defer
+        self.screen.append(self.blank_row())
+
 
+    def shrink_screen(self, n):
+        # Remove the top n rows of the screen and return them
+        rows = self.screen[:n]
+        del self.screen[:n]
+        return rows
 
-    def poke(self, y, x, s):
-        pos = self.w * y + x
-        self.screen[pos:pos + len(s)] = s
+
+    def poke(self, y, x, s, narrow=False):
+        # narrow tells that s has no double width characters
+        n = len(s)
+        if not n:
+            return
+        w = self.w
+        if x >= w:
+            y, x = y + x // w, x % w
+        if x + n <= w:
+            self.screen[y][x:x + n] = s
+            self.width_update(y, x, s, narrow)
+            self.touch(y, y + 1)
+            return
+        # Split cells that continue on the following rows
+        y0 = y
+        i = 0
+        while i < n and y < self.h:
+            k = min(w - x, n - i)
+            chunk = s[i:i + k]
+            self.screen[y][x:x + k] = chunk
+            self.width_update(y, x, chunk, narrow)
+            i += k
+            y += 1
+            x = 0
+        self.touch(y0, y)
+
+
+    def touch(self, y0, y1):
+        # Mark rows y0 to y1 (exclusive) as changed
+        y1 = min(y1, self.h)
+        if y1 > y0:
+            self.generation += 1
+            self.row_gen[y0:y1] = [self.generation] * (y1 - y0)
+
+
+    def width_update(self, y, x, s, narrow=False):
+        # Update the width index for cells s written at row y, column x
+        for cols in self.width_cols[y]:
+            if cols:
+                lo = bisect.bisect_left(cols, x)
+                hi = bisect.bisect_left(cols, x + len(s))
+                del cols[lo:hi]
+        if narrow:
+            return
+        data = s.tobytes()
+        if (max(data[CELL_BYTE1::4]) < SPECIAL_MIN_HIGH_BYTE and
+                not max(data[CELL_BYTE2::4].translate(CELL_BYTE2_CHAR))):
+            return
+        for cols, found in zip(self.width_cols[y],
+                               charwidth.special_columns(cells_text(data))):
+            if found:
+                i = bisect.bisect_left(cols, x)
+                cols[i:i] = [x + c for c in found]
+
+
+    def cells(self, s):
+        # Screen cells for a string in the current style: encode it as
+        # UTF-32 and set the style bits bytewise instead of building every
+        # cell in Python.
+        cells = bytearray(s.encode(CELL_CODEC))
+        attr = self.attr
+        if attr:
+            cells[CELL_BYTE3::4] = bytes((attr >> 24,)) * len(s)
+            cells[CELL_BYTE2::4] = cells[CELL_BYTE2::4].translate(
+                CELL_BYTE2_WITH_STYLE[(attr >> CELL_STYLE_SHIFT) & 7])
+        return array.array('I', cells)
 
 
     def fill(self, y0, x0, y1, x1, char):
         n = self.w * (y1 - y0 - 1) + (x1 - x0)
-        self.poke(y0, x0, array.array('i', [char] * n))
+        self.poke(y0, x0, array.array('I', [char]) * n,
+                  self.utf8_charwidth(char & CELL_CHAR) == 1)
 
 
     def clear(self, y0, x0, y1, x1):
@@ -306,23 +874,60 @@ class Terminal(object):
 
     # Scrolling functions
     def scroll_area_up(self, y0, y1, n = 1):
-        self.history.write_line(self.peek(0, 0, 1, self.w))
+        rows = self.screen
+        if y0 == 0:
+            # The top row leaves the screen, so history can keep it
+            self.history.write_line(rows[0])
+        else:
+            self.history.write_line(rows[0][:])
         # normaly: min(24-0, 1) = 1
         n = min(y1-y0, n)
         # most times it would be: y0 = 0, y1 = self.h (default 24)
-        # example for next lines: 
-        # 0, 0, peek(1, 0, 24, 80) - from begin the text from line 1 down is written
-        self.poke(y0, 0, self.peek(y0 + n, 0, y1, self.w))
-        # clear may do:
-        # poke(23, 0, array.array('i', [self.attr | 0x20] * (80*0+80-0 = 80)
-        # that means: put on screen line 23 noting
-        self.clear(y1-n, 0, y1, self.w)
+        # the rows below y0 + n move up by n, blank rows come in at y1
+        rows[y0:y1] = rows[y0 + n:y1] + [self.blank_row() for y in range(n)]
+        self.width_cols[y0:y1] = (self.width_cols[y0 + n:y1] +
+                                  [([], []) for y in range(n)])
+        self.touch(y0, y1)
 
 
     def scroll_area_down(self, y0, y1, n = 1):
+        rows = self.screen
         n = min(y1-y0, n)
-        self.poke(y0 + n, 0, self.peek(y0, 0, y1-n, self.w))
-        self.clear(y0, 0, y0 + n, self.w)
+        rows[y0:y1] = [self.blank_row() for y in range(n)] + rows[y0:y1 - n]
+        self.width_cols[y0:y1] = ([([], []) for y in range(n)] +
+                                  self.width_cols[y0:y1 - n])
+        self.touch(y0, y1)
+
+
+    def scroll_defer(self):
+        # Scroll the full screen up by one line. The screen grows by a blank
+        # row at the bottom and scroll_flush later drops all rows above the
+        # visible area at once. Only printing, CR and LF may happen in
+        # between, which is ensured by write.
+        self.grow_screen()
+        self.width_cols.append(([], []))
+        self.row_gen.append(self.generation)
+        self.h += 1
+        self.scroll_area_y1 += 1
+        self.cy += 1
+        self.scroll_pending += 1
+        # At most one screen height of rows is kept back
+        if 2 * self.scroll_pending >= self.h:
+            self.scroll_flush()
+
+
+    def scroll_flush(self):
+        # Apply the scrolls deferred by scroll_defer as a single scroll
+        n = self.scroll_pending
+        if n:
+            self.scroll_pending = 0
+            self.history.write_lines(self.shrink_screen(n))
+            del self.width_cols[:n]
+            del self.row_gen[:n]
+            self.h -= n
+            self.scroll_area_y1 -= n
+            self.cy -= n
+            self.touch(0, self.h)
 
 
     def scroll_area_set(self, y0, y1):
@@ -336,25 +941,41 @@ class Terminal(object):
     def scroll_line_right(self, y, x, n = 1):
         if x < self.w:
             n = min(self.w-self.cx, n)
-            self.poke(y, x + n, self.peek(y, x, y + 1, self.w - n))
+            row = self.screen[y]
+            row[x + n:self.w] = row[x:self.w - n]
+            for cols in self.width_cols[y]:
+                if cols:
+                    i = bisect.bisect_left(cols, x)
+                    cols[i:] = [c + n for c in cols[i:] if c + n < self.w]
+            self.touch(y, y + 1)
             self.clear(y, x, y + 1, x + n)
 
 
     def scroll_line_left(self, y, x, n = 1):
         if x < self.w:
             n = min(self.w - self.cx, n)
-            self.poke(y, x, self.peek(y, x + n, y + 1, self.w))
+            row = self.screen[y]
+            row[x:self.w - n] = row[x + n:self.w]
+            for cols in self.width_cols[y]:
+                if cols:
+                    i = bisect.bisect_left(cols, x)
+                    j = bisect.bisect_left(cols, x + n)
+                    cols[i:] = [c - n for c in cols[j:]]
+            self.touch(y, y + 1)
             self.clear(y, self.w - n, y + 1, self.w)
 
 
     # Cursor functions
     def cursor_line_width(self, next_char):
-        wx = self.utf8_charwidth(next_char)
-        lx = 0
-        for x in range(min(self.cx, self.w)):
-            char = self.peek(self.cy, x, self.cy + 1, x + 1)[0] & 0xffff
-            wx += self.utf8_charwidth(char)
-            lx += 1
+        # Display width of the cells left of the cursor plus next_char, and
+        # the number of those cells
+        lx = min(self.cx, self.w)
+        wx = self.utf8_charwidth(next_char) + lx
+        wide, zero = self.width_cols[self.cy]
+        if wide:
+            wx += bisect.bisect_left(wide, lx)
+        if zero:
+            wx -= bisect.bisect_left(zero, lx)
         return wx, lx
 
 
@@ -414,7 +1035,11 @@ class Terminal(object):
         if self.vt100_mode_lfnewline:
             self.ctrl_CR()
         if self.cy == self.scroll_area_y1 - 1:
-            self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1)
+            if (self.scroll_coalesce and self.scroll_area_y0 == 0 and
+                    self.scroll_area_y1 == self.h):
+                self.scroll_defer()
+            else:
+                self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1)
         else:
             self.cursor_down()
 
@@ -440,8 +1065,8 @@ class Terminal(object):
     def dumb_echo(self, char):
         # Check right bound
         wx, cx = self.cursor_line_width(char)
-        # Newline
-        if wx > self.w:
+        # Newline, zero width characters need a cell too
+        if wx > self.w or cx >= self.w:
             if self.vt100_mode_autowrap:
                 self.ctrl_CR()
                 self.ctrl_LF()
@@ -453,10 +1078,61 @@ class Terminal(object):
             self.vt100_charset_is_single_shift = False
         elif self.vt100_charset_is_graphical and (char & 0xffe0) == 0x0060:
             char = self.vt100_charset_graph[char - 0x60]
-        self.poke(self.cy, self.cx, array.array('i', [self.attr | char]))
+        self.poke(self.cy, self.cx, array.array('I', [self.attr | char]))
         self.cursor_set_x(self.cx + 1)
 
 
+    def dumb_echo_run(self, s):
+        # Same as dumb_echo for every character of s, but the charset is
+        # applied once and each line segment is written as a single slice
+        if self.vt100_charset_is_single_shift:
+            self.vt100_charset_is_single_shift = False
+            if self.vt100_charset_is_graphical:
+                s = s[0] + s[1:].translate(self.vt100_charset_graph_table)
+        elif self.vt100_charset_is_graphical:
+            s = s.translate(self.vt100_charset_graph_table)
+        i, n = 0, len(s)
+        while i < n:
+            char = ord(s[i])
+            wx, cx = self.cursor_line_width(char)
+            if wx > self.w or cx >= self.w:
+                if not self.vt100_mode_autowrap:
+                    self.dumb_echo_overflow(s[i:])
+                    return
+                self.ctrl_CR()
+                self.ctrl_LF()
+                wx, cx = self.cursor_line_width(char)
+            # Characters that fit before the right margin, limited by the
+            # cells and by the columns left
+            columns = self.w - wx + self.utf8_charwidth(char)
+            segment = s[i:i + self.w - cx]
+            narrow = max(segment) <= charwidth.NARROW_MAX
+            if narrow:
+                segment = segment[:columns]
+            else:
+                segment = segment[:charwidth.fit_width(segment, columns)]
+            k = len(segment)
+            if self.vt100_mode_insert:
+                self.scroll_line_right(self.cy, self.cx, k)
+            self.poke(self.cy, self.cx, self.cells(segment), narrow)
+            self.cursor_set_x(self.cx + k)
+            i += k
+
+
+    def dumb_echo_overflow(self, s):
+        # Without autowrap every character that does not fit any more is
+        # written over the last cell of the line
+        for c in s:
+            char = ord(c)
+            wx, cx = self.cursor_line_width(char)
+            if wx > self.w or cx >= self.w:
+                self.cx = cx - 1
+            if self.vt100_mode_insert:
+                self.scroll_line_right(self.cy, self.cx)
+            self.poke(self.cy, self.cx, array.array('I', [self.attr | char]))
+            self.cursor_set_x(self.cx + 1)
+
+
     # VT100 CTRL, ESC, CSI handlers
     def vt100_charset_update(self):
         self.vt100_charset_is_graphical = (
@@ -499,6 +1175,7 @@ class Terminal(object):
             elif m == '?5':
                 # Screen mode
                 self.vt100_mode_inverse = state
+                self.touch(0, self.h)
             elif m == '?6':
                 # Region origin mode
                 self.vt100_mode_origin = state
@@ -520,6 +1197,8 @@ class Terminal(object):
                 if ((state and not self.vt100_mode_alt_screen) or
                     (not state and self.vt100_mode_alt_screen)):
                     self.screen, self.screen2 = self.screen2, self.screen
+                    self.width_cols, self.width_cols2 = self.width_cols2, self.width_cols
+                    self.touch(0, self.h)
                     self.vt100_saved, self.vt100_saved2 = self.vt100_saved2, self.vt100_saved
                 self.vt100_mode_alt_screen = state
             elif m == '?67':
@@ -544,7 +1223,7 @@ class Terminal(object):
 
     def esc_DECALN(self):
         # Screen alignment display
-        self.fill(0, 0, self.h, self.w, 0x00fe0045)
+        self.fill(0, 0, self.h, self.w, 0x45)
 
 
     def esc_G0_0(self):
@@ -910,41 +1589,64 @@ class Terminal(object):
 
     def csi_SGR(self, p):
         # Select graphic rendition
+        if isinstance(p, str):
+            p = self.vt100_split_params(p)
+        if p[0]:
+            # Private sequences such as xterm's modifyOtherKeys (CSI > m)
+            return
         p = self.vt100_parse_params(p, [0])
-        for m in p:
+        key = (self.attr, tuple(p))
+        attr = self.sgr_cache.get(key)
+        if attr is not None:
+            self.attr = attr
+            return
+        fg, bg, flags = self.palette[self.attr >> CELL_STYLE_SHIFT]
+        i, n = 0, len(p)
+        while i < n:
+            m = p[i] or 0
+            i += 1
             if m == 0:
                 # Reset
-                self.attr = 0x00fe0000
-            elif m == 4:
-                # Underlined
-                self.attr |= 0x01000000
-            elif m == 7:
-                # Negative
-                self.attr |= 0x02000000
-            elif m == 8:
-                # Concealed
-                self.attr |= 0x04000000
-            elif m == 24:
-                # Not underlined
-                self.attr &= 0x7eff0000
-            elif m == 27:
-                # Positive
-                self.attr &= 0x7dff0000
-            elif m == 28:
-                # Revealed
-                self.attr &= 0x7bff0000
+                fg, bg, flags = DEFAULT_STYLE
+            elif m in SGR_SET_FLAGS:
+                flags |= SGR_SET_FLAGS[m]
+            elif m in SGR_RESET_FLAGS:
+                flags &= ~SGR_RESET_FLAGS[m]
             elif m >= 30 and m <= 37:
                 # Foreground
-                self.attr = (self.attr & 0x7f0f0000) | ((m - 30) << 20)
+                fg = m - 30
+            elif m >= 90 and m <= 97:
+                # Bright foreground
+                fg = m - 90 + 8
             elif m == 39:
                 # Default fg color
-                self.attr = (self.attr & 0x7f0f0000) | 0x00f00000
+                fg = None
             elif m >= 40 and m <= 47:
                 # Background
-                self.attr = (self.attr & 0x7ff00000) | ((m - 40) << 16)
+                bg = m - 40
+            elif m >= 100 and m <= 107:
+                # Bright background
+                bg = m - 100 + 8
             elif m == 49:
                 # Default bg color
-                self.attr = (self.attr & 0x7ff00000) | 0x000e0000
+                bg = None
+            elif m == 38 or m == 48:
+                # 256 color (5;n) or truecolor (2;r;g;b)
+                values = [min(max(v or 0, 0), 255) for v in p[i:i + 4]]
+                if values[:1] == [5] and len(values) >= 2:
+                    color = values[1]
+                    i += 2
+                elif values[:1] == [2] and len(values) == 4:
+                    color = tuple(values[1:])
+                    i += 4
+                else:
+                    break
+                if m == 38:
+                    fg = color
+                else:
+                    bg = color
+        self.attr = self.sgr_cache.store(
+            key, self.palette.intern(Style(fg, bg, flags)) << CELL_STYLE_SHIFT)
 
 
     def csi_DSR(self, p):
@@ -1012,105 +1714,191 @@ class Terminal(object):
     # VT100 Parser
     def vt100_parse_params(self, p, d, to_int = True):
         # Process parameters (params p with defaults d)
-        # Add prefix to all parameters
-        prefix = ''
-        if len(p) > 0:
-            if p[0] >= '<' and p[0] <= '?':
-                prefix = p[0]
-                p = p[1:]
-            p = p.split(';')
+        # p is either a parameter string or the (prefix, values) pair
+        # collected by the parser
+        if isinstance(p, str):
+            p = self.vt100_split_params(p)
+        # Sequences from the cache remember their last parsed parameters
+        entry = self.vt100_parse_entry
+        if entry is not None and entry[1] is p:
+            if entry[2] == d and entry[3] == to_int:
+                return entry[4]
         else:
-            p = ''
+            entry = None
+        prefix, values = p
         # Process parameters
-        n = max(len(p), len(d))
+        n = max(len(values), len(d))
         o = []
         for i in range(n):
             value_def = False
-            if i < len(p):
-                value = prefix + p[i]
+            if i < len(values):
+                value = values[i]
                 value_def = True
                 if to_int:
-                    try:
-                        value = int(value)
-                    except ValueError:
+                    # Prefixed, empty and malformed values are not numbers
+                    if prefix or value is None or value < 0:
                         value_def = False
+                elif value is None:
+                    value = prefix
+                else:
+                    value = prefix + str(value)
             if (not value_def) and i < len(d):
                 value = d[i]
             o.append(value)
+        if entry is not None:
+            entry[2:] = d, to_int, o
         return o
 
 
+    def vt100_split_params(self, p):
+        # Parse a parameter string into the parser's (prefix, values) form
+        prefix = ''
+        values = []
+        if len(p) > 0:
+            if p[0] >= '<' and p[0] <= '?':
+                prefix = p[0]
+                p = p[1:]
+            for value in p.split(';'):
+                if not value:
+                    values.append(None)
+                elif value.isdigit():
+                    values.append(int(value))
+                else:
+                    values.append(-1)
+        return prefix, tuple(values)
+
+
     def vt100_parse_reset(self, vt100_parse_state = ""):
         self.vt100_parse_state = vt100_parse_state
         self.vt100_parse_len = 0
         self.vt100_parse_func = ""
-        self.vt100_parse_param = ""
+        self.vt100_parse_prefix = ""
+        self.vt100_parse_values = []
+        self.vt100_parse_malformed = False
 
 
     def vt100_parse_process(self):
-        if self.vt100_parse_state == 'esc':
+        state = self.vt100_parse_state
+        if state == 'esc' or state == 'esc_int':
             # ESC mode
             f = self.vt100_parse_func
             try:
                 self.vt100_esc[f]()
             except KeyError:
                 pass
-            if self.vt100_parse_state == 'esc':
+            if self.vt100_parse_state == state:
                 self.vt100_parse_reset()
         else:
-            # CSI mode
-            f = self.vt100_parse_func
-            p = self.vt100_parse_param
-            try:
-                self.vt100_csi[f](p)
-            except KeyError:
-                pass
-            if self.vt100_parse_state == 'csi':
+            # CSI mode, the handler and parameters of a sequence are cached
+            # so that repeated sequences skip the lookup and the parameter
+            # parsing in their handler
+            if not self.vt100_parse_malformed:
+                key = (self.vt100_parse_func, self.vt100_parse_prefix,
+                       tuple(self.vt100_parse_values))
+                cache = self.vt100_cache
+                entry = cache.get(key)
+                if entry is None:
+                    cache.misses += 1
+                    # Handler, parameters and the last parsed parameters
+                    entry = cache.store(
+                        key, [self.vt100_csi.get(key[0]), key[1:], None, None, None])
+                else:
+                    cache.move_to_end(key)
+                    cache.hits += 1
+                f = entry[0]
+                self.vt100_parse_entry = entry
+                try:
+                    if f is not None:
+                        f(entry[1])
+                except KeyError:
+                    pass
+                self.vt100_parse_entry = None
+            if self.vt100_parse_state == state:
                 self.vt100_parse_reset()
 
 
+    def vt100_parse(self, d, i):
+        # Feed the ESC and CSI sequence bytes of d from index i on to the
+        # parser. Returns the index of the first character that has to go
+        # through vt100_write.
+        n = len(d)
+        state = self.vt100_parse_state
+        while i < n and state and state != 'str':
+            char = ord(d[i])
+            action = VT100_ACTIONS[state][char if char < 0xa0 else 0xa0]
+            if action < VT100_FINAL or self.vt100_parse_len >= 32:
+                break
+            i += 1
+            self.vt100_parse_len += 1
+            if action == VT100_PARAM:
+                values = self.vt100_parse_values
+                if not values:
+                    values.append(char - 0x30)
+                else:
+                    value = values[-1]
+                    if value is None:
+                        values[-1] = char - 0x30
+                    elif value >= 0:
+                        values[-1] = value * 10 + char - 0x30
+            elif action == VT100_FINAL:
+                self.vt100_parse_func += chr(char)
+                self.vt100_parse_process()
+                state = self.vt100_parse_state
+            elif action == VT100_SEPARATOR:
+                values = self.vt100_parse_values
+                if not values:
+                    values.append(None)
+                values.append(None)
+            elif action == VT100_PREFIX:
+                values = self.vt100_parse_values
+                if self.vt100_parse_len == 1 and char >= 0x3c:
+                    # Private parameter prefix
+                    self.vt100_parse_prefix = chr(char)
+                    values.append(None)
+                elif values:
+                    values[-1] = -1
+                else:
+                    values.append(-1)
+            elif action == VT100_INTERMEDIATE:
+                self.vt100_parse_func += chr(char)
+                state = VT100_INTERMEDIATE_STATE[state]
+                self.vt100_parse_state = state
+            else:
+                # Parameter byte after an intermediate byte
+                self.vt100_parse_malformed = True
+        return i
+
+
     def vt100_write(self, char):
-        if char < 32:
-            if char == 27:
-                self.vt100_parse_reset('esc')
+        # Returns True if char was consumed by the parser, False if it has
+        # to be executed or echoed by the dumb terminal
+        action = VT100_ACTIONS[self.vt100_parse_state][min(char, 0xa0)]
+        if action >= VT100_FINAL:
+            if self.vt100_parse_len < 32:
+                self.vt100_parse(chr(char), 0)
                 return True
-            elif char == 14:
-                self.ctrl_SO()
-            elif char == 15:
-                self.ctrl_SI()
-        elif (char & 0xffe0) == 0x0080:
+            # Sequence too long
+            self.vt100_parse_reset()
+        elif action == VT100_IGNORE:
+            return True
+        elif action == VT100_ESC:
+            self.vt100_parse_reset('esc')
+            return True
+        elif action == VT100_C1:
             self.vt100_parse_reset('esc')
             self.vt100_parse_func = chr(char - 0x40)
             self.vt100_parse_process()
             return True
-
-        if self.vt100_parse_state:
-            if self.vt100_parse_state == 'str':
-                if char >= 32:
-                    return True
-                self.vt100_parse_reset()
-            else:
-                if char < 32:
-                    if char == 24 or char == 26:
-                        self.vt100_parse_reset()
-                        return True
-                else:
-                    self.vt100_parse_len += 1
-                    if self.vt100_parse_len > 32:
-                        self.vt100_parse_reset()
-                    else:
-                        char_msb = char & 0xf0
-                        if char_msb == 0x20:
-                            # Intermediate bytes (added to function)
-                            self.vt100_parse_func += chr(char)
-                        elif char_msb == 0x30 and self.vt100_parse_state == 'csi':
-                            # Parameter byte
-                            self.vt100_parse_param += chr(char)
-                        else:
-                            # Function byte
-                            self.vt100_parse_func += chr(char)
-                            self.vt100_parse_process()
-                        return True
+        elif action == VT100_CANCEL:
+            self.vt100_parse_reset()
+            return True
+        elif action == VT100_SO:
+            self.ctrl_SO()
+        elif action == VT100_SI:
+            self.ctrl_SI()
+        if self.vt100_parse_state == 'str' and char < 32:
+            # Control characters terminate strings
+            self.vt100_parse_reset()
         self.vt100_lastchar = char
         return False
 
@@ -1122,6 +1910,7 @@ class Terminal(object):
         self.w = w
         self.h = h
         self.reset_screen()
+        self.publish()
         return True
 
 
@@ -1132,18 +1921,80 @@ class Terminal(object):
 
 
     def write(self, d):
-        d = self.utf8_decode(d)
-        for c in d:
-            char = ord(c)
+        # d may be any bytes-like object, e.g. a memoryview of a read buffer
+        d = self.utf8_decoder.decode(d)
+        printable_run = PRINTABLE_RUN.match
+        string_body = STRING_BODY.match
+        i, n = 0, len(d)
+        # Consecutive full screen scrolls are coalesced as long as only
+        # text, CR and LF follow them
+        self.scroll_coalesce = True
+        while i < n:
+            state = self.vt100_parse_state
+            if not state:
+                m = printable_run(d, i)
+                if m:
+                    run = m.group()
+                    self.dumb_echo_run(run)
+                    self.vt100_lastchar = ord(run[-1])
+                    i = m.end()
+                    continue
+            elif state == 'str':
+                m = string_body(d, i)
+                if m:
+                    i = m.end()
+                    continue
+            else:
+                if self.scroll_pending:
+                    self.scroll_flush()
+                j = self.vt100_parse(d, i)
+                if j != i:
+                    i = j
+                    continue
+            char = ord(d[i])
+            i += 1
+            if self.scroll_pending and char != 10 and char != 13:
+                self.scroll_flush()
             if self.vt100_write(char):
                 continue
             if self.dumb_write(char):
                 continue
-            if char <= 0xffff:
-                self.dumb_echo(char)
+            self.dumb_echo(char)
+        self.scroll_flush()
+        self.scroll_coalesce = False
+        self.cursor_update()
+        self.publish()
         return True
 
 
+    def publish(self):
+        # Replace the snapshot, rows unchanged since the last one are
+        # shared with it
+        last = self.snapshot
+        if last is None or last.w != self.w or last.h != self.h:
+            rows = tuple(row.tobytes() for row in self.screen)
+        else:
+            since = last.generation
+            rows = tuple(last.rows[y] if generation <= since
+                         else self.screen[y].tobytes()
+                         for y, generation in enumerate(self.row_gen))
+        self.snapshot = ScreenSnapshot(
+            self.generation, self.w, self.h, rows, tuple(self.row_gen),
+            (min(self.cx, self.w - 1), self.cy, self.vt100_mode_cursor),
+            self.vt100_mode_inverse, self.history.written, self.resets)
+
+
+    def cursor_update(self):
+        # The cursor is drawn into the dumped rows, so the rows it left and
+        # entered count as changed
+        state = (min(self.cx, self.w - 1), self.cy, self.vt100_mode_cursor)
+        if state != self.cursor_state:
+            if self.cursor_state is not None:
+                self.touch(self.cursor_state[1], self.cursor_state[1] + 1)
+            self.touch(self.cy, self.cy + 1)
+            self.cursor_state = state
+
+
     def pipe(self, d):
         o = ''
         d = self.utf8_decode(d)
@@ -1172,79 +2023,313 @@ class Terminal(object):
         return o
 
 
-    def dump(self, screenarray=None):
-        if screenarray == None:
-            screenarray = self.screen
-        screen = []
-        attr_ = -1
-        cx, cy = min(self.cx, self.w - 1), self.cy
-        for y in range(0, self.h):
-            wx = 0
-            line = [""]
-            for x in range(0, self.w):
-                d = screenarray[y * self.w + x]
-                char = d & 0xffff
-                attr = d >> 16
-                # Cursor
-                if cy == y and cx == x and self.vt100_mode_cursor:
-                    attr = attr & 0xfff0 | 0x000c
-                # Attributes
-                if attr != attr_:
-                    if attr_ != -1:
-                        line.append("")
-                    bg = attr & 0x000f
-                    fg = (attr & 0x00f0) >> 4
-                    # Inverse
-                    inv = attr & 0x0200
-                    inv2 = self.vt100_mode_inverse
-                    if (inv and not inv2) or (inv2 and not inv):
-                        fg, bg = bg, fg
-                    # Concealed
-                    if attr & 0x0400:
-                        fg = 0xc
-                    # Underline
-                    if attr & 0x0100:
-                        ul = True
-                    else:
-                        ul = False
-                    line.append((fg, bg, ul))
-                    line.append("")
-                    attr_ = attr
-                wx += self.utf8_charwidth(char)
-                if wx <= self.w:
-                    line[-1] += chr(char)
-            screen.append(line)
+    def search(self, query, regex=False, limit=1000):
+        # Find query in the screen and the history, most recent first. A
+        # match is returned as (scrollback, y, x): the scrollback offset
+        # to show it and its row and column in that view.
+        pattern = re.compile(query if regex else re.escape(query),
+                             re.MULTILINE)
+        results = []
+        for y in range(self.h - 1, -1, -1):
+            for match in pattern.finditer(row_text(self.screen[y])):
+                results.append((0, y, match.start()))
+        for index, x in self.history.search(pattern):
+            if len(results) >= limit:
+                break
+            results.append((index + 1, 0, x))
+        return results[:limit]
+
+
+    def dump(self, rows=None):
+        # The published screen, or rows such as a history view, with the
+        # published cursor
+        snapshot = self.snapshot
+        if rows is None:
+            rows = snapshot.rows
+        return snapshot.cursor[:2], self.dump_lines(snapshot, rows,
+                                                    range(snapshot.h))
+
 
-        return (cx, cy), screen
+    def dump_history(self, scrollback):
+        # Rows shown when scrolled back by scrollback lines: history rows
+        # followed by the top of the published screen, h rows in total
+        snapshot = self.snapshot
+        history = self.history
+        with history.lock:
+            rows = history.view(scrollback, snapshot.h,
+                                history.written - snapshot.history_written)
+        rows += snapshot.rows[:snapshot.h - len(rows)]
+        return snapshot.cursor[:2], self.dump_lines(snapshot, rows,
+                                                    range(snapshot.h))
+
+
+    def dump_changes(self, since_generation):
+        # Rows changed after since_generation, by row number, together with
+        # the cursor and the current generation
+        snapshot = self.snapshot
+        ys = [y for y, generation in enumerate(snapshot.row_gen)
+              if generation > since_generation]
+        lines = self.dump_lines(snapshot, snapshot.rows, ys)
+        return snapshot.cursor[:2], snapshot.generation, dict(zip(ys, lines))
+
+
+    def dump_lines(self, snapshot, rows, ys):
+        # Dumped rows ys of rows, with the screen mode of snapshot
+        with self.dump_lock:
+            mode = (snapshot.w, snapshot.inverse, snapshot.resets)
+            if mode != self.dump_mode:
+                self.dump_rows.clear()
+                self.dump_cache.clear()
+                self.dump_mode = mode
+            self.dumping = snapshot
+            return [self.dump_line(rows, y) for y in ys]
+
+
+    def dump_line(self, rows, y):
+        # Dumped rows are cached without the cursor, snapshot rows by their
+        # generation and all rows by their content. The lines are shared
+        # and must not be modified.
+        snapshot = self.dumping
+        if rows is snapshot.rows:
+            cached = self.dump_rows.get(y)
+            if cached is not None and cached[0] == snapshot.row_gen[y]:
+                line = cached[1]
+            else:
+                line = self.dump_row(rows[y])
+                self.dump_rows[y] = (snapshot.row_gen[y], line)
+        else:
+            line = self.dump_row(rows[y])
+        cx, cy, visible = snapshot.cursor
+        if y == cy and visible:
+            line = self.dump_cursor(line, cx)
+        return line
+
+
+    def dump_row(self, row):
+        key = bytes(row)
+        line = self.dump_cache.get(key)
+        if line is None:
+            line = self.dump_cache.store(key, self.dump_runs(key))
+        return line
+
+
+    def dump_runs(self, data):
+        # Rows from history may be narrower than the screen
+        w = self.dumping.w
+        data = data[:w * 4]
+        text = cells_text(data)
+        if text and max(text) > charwidth.NARROW_MAX:
+            # Characters past the right margin are cut off
+            n = charwidth.fit_width(text, w)
+            text = text[:n]
+            data = data[:n * 4]
+        # Style indexes as two bytes per cell, split into runs
+        sids = bytearray(len(data) // 2)
+        sids[0::2] = data[CELL_BYTE3::4]
+        sids[1::2] = data[CELL_BYTE2::4].translate(CELL_BYTE2_STYLE)
+        line = [""]
+        for m in STYLE_RUN.finditer(sids):
+            if len(line) > 1:
+                line.append("")
+            line.append(self.dump_style(sids[m.start()] << 3 |
+                                        sids[m.start() + 1]))
+            line.append(text[m.start() // 2:m.end() // 2])
+        return line
+
+
+    def dump_cursor(self, line, cx):
+        # Copy of a dumped line with the cell at cx in a run of its own
+        x = 0
+        for i in range(2, len(line), 3):
+            text = line[i]
+            if x <= cx < x + len(text):
+                style = line[i - 1]
+                k = cx - x
+                runs = [(style, text[:k]),
+                        (style._replace(cursor=True), text[k]),
+                        (style, text[k + 1:])]
+                result = line[:i - 2]
+                for style, text in runs:
+                    if text:
+                        result += ["", style, text]
+                return result + line[i + 1:]
+            x += len(text)
+        return line
+
+
+    def dump_style(self, sid):
+        # DumpStyle for a style index, memoized per screen mode
+        key = (sid, self.dumping.inverse)
+        try:
+            return self.dump_styles[key]
+        except KeyError:
+            pass
+        fg, bg, flags = self.palette[sid]
+        if self.dumping.inverse:
+            flags ^= STYLE_INVERSE
+        style = DumpStyle(fg, bg, bool(flags & STYLE_UNDERLINE), flags, False)
+        self.dump_styles[key] = style
+        return style
 
         
 
-def synchronized(func):
-    def wrapper(self, *args, **kwargs):
-        try:
-            self.lock.acquire()
-        except AttributeError:
-            self.lock = threading.RLock()
-            self.lock.acquire()
-        try:
-            result = func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-        return result
+class NumpyTerminal(Terminal):
+    # Terminal keeping the screen in a NumPy uint32 grid of h rows by w
+    # cells. Fills and scrolls are slice operations on the grid and dump
+    # finds style runs with vectorized comparisons. Rows of the grid are
+    # views, so rows going to the history are copied.
+    # The screen is a view of the top rows of a grid with h spare rows.
+    # Deferred scrolls extend the view and scroll_flush moves the rows
+    # back up with one copy.
+    def blank_screen(self):
+        grid = numpy.full((2 * self.h, self.w), self.attr | 0x20,
+                          dtype=numpy.uint32)
+        return grid[:self.h]
+
+
+    def grow_screen(self):
+        # scroll_flush runs before the spare rows run out
+        self.screen = self.screen.base[:self.h + 1]
+        self.screen[self.h] = self.attr | 0x20
+
+
+    def shrink_screen(self, n):
+        grid = self.screen.base
+        rows = list(grid[:n].copy())
+        h = self.h - n
+        grid[:h] = grid[n:self.h]
+        self.screen = grid[:h]
+        return rows
+
+
+    def fill(self, y0, x0, y1, x1, char):
+        w = self.w
+        start = y0 * w + x0
+        end = min(start + w * (y1 - y0 - 1) + (x1 - x0), self.h * w)
+        if end <= start:
+            return
+        self.screen.reshape(-1)[start:end] = char
+        y0, y1 = start // w, (end - 1) // w + 1
+        if self.utf8_charwidth(char & CELL_CHAR) == 1:
+            # Rows covered completely by a narrow fill lose their index
+            ya = y0 + (start % w > 0)
+            yb = max(y1 - (end % w > 0), ya)
+            self.width_cols[ya:yb] = [([], []) for y in range(ya, yb)]
+            for y in {y0, y1 - 1} - set(range(ya, yb)):
+                x = max(start - y * w, 0)
+                self.width_update(y, x, range(x, min(end - y * w, w)), True)
+        else:
+            for y in range(y0, y1):
+                x = max(start - y * w, 0)
+                self.width_update(y, x, self.screen[y, x:min(end - y * w, w)])
+        self.touch(y0, y1)
+
+
+    def scroll_area_up(self, y0, y1, n = 1):
+        rows = self.screen
+        self.history.write_line(rows[0].copy())
+        n = min(y1 - y0, n)
+        rows[y0:y1 - n] = rows[y0 + n:y1]
+        rows[y1 - n:y1] = self.attr | 0x20
+        self.width_cols[y0:y1] = (self.width_cols[y0 + n:y1] +
+                                  [([], []) for y in range(n)])
+        self.touch(y0, y1)
+
+
+    def scroll_area_down(self, y0, y1, n = 1):
+        rows = self.screen
+        n = min(y1 - y0, n)
+        rows[y0 + n:y1] = rows[y0:y1 - n]
+        rows[y0:y0 + n] = self.attr | 0x20
+        self.width_cols[y0:y1] = ([([], []) for y in range(n)] +
+                                  self.width_cols[y0:y1 - n])
+        self.touch(y0, y1)
+
+
+    def dump_runs(self, data):
+        w = self.dumping.w
+        cells = numpy.frombuffer(data, dtype=numpy.uint32)[:w]
+        text = (cells & CELL_CHAR).tobytes().decode(CELL_CODEC,
+                                                     'surrogatepass')
+        if text and max(text) > charwidth.NARROW_MAX:
+            # Characters past the right margin are cut off
+            text = text[:charwidth.fit_width(text, w)]
+            cells = cells[:len(text)]
+        if not len(text):
+            return [""]
+        sids = cells >> CELL_STYLE_SHIFT
+        bounds = (numpy.flatnonzero(sids[1:] != sids[:-1]) + 1).tolist()
+        line = [""]
+        for x0, x1 in zip([0] + bounds, bounds + [len(text)]):
+            if len(line) > 1:
+                line.append("")
+            line.append(self.dump_style(int(sids[x0])))
+            line.append(text[x0:x1])
+        return line
+
+
+def terminal_class(engine=None):
+    # Terminal implementation for a session: 'numpy' for NumpyTerminal,
+    # which falls back to Terminal without NumPy
+    if engine == 'numpy' and numpy is not None:
+        return NumpyTerminal
+    return Terminal
+
+
+
+def session_synchronized(func):
+    # Hold only the lock of session sid: the global lock guards the lookup
+    # in the session table, so a busy session does not block the others
+    def wrapper(self, sid, *args, **kwargs):
+        with self.lock:
+            session = self.session.get(sid)
+        if session is None:
+            return func(self, sid, *args, **kwargs)
+        with session['lock']:
+            return func(self, sid, *args, **kwargs)
     return wrapper
 
 
 class Multiplexer(object):
-    def __init__(self, cmd="/bin/bash", env_term = "xterm-color", timeout=60*60*24):
+    def __init__(self, cmd="/bin/bash", env_term = "xterm-color", timeout=60*60*24,
+                 history_bytes=4 << 20, history_spill_bytes=0,
+                 history_spill_dir=None, engine=None):
         # Set Linux signal handler
         if sys.platform in ("linux2", "linux3"):
             self.sigchldhandler = signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-        # Session
+        # Session table, each session has its own lock for its state
         self.session = {}
+        self.lock = threading.RLock()
         self.cmd = cmd
         self.env_term = env_term
         self.timeout = timeout
+        # Scrollback memory per session, the budget for all sessions is
+        # process wide, see History.set_total_budget
+        self.history_bytes = history_bytes
+        # Disk space per session for scrollback that does not fit in memory
+        self.history_spill_bytes = history_spill_bytes
+        self.history_spill_dir = history_spill_dir
+        # Screen engine for sessions that do not choose one
+        self.engine = engine
+        # Read buffer of the supervisor thread, proc_read decodes it in place
+        self.read_buffer = bytearray(65536)
+        self.read_view = memoryview(self.read_buffer)
+
+        # Timed out sessions are looked for once per expire_interval seconds
+        self.expire_interval = 1.0
+        self.expire_time = 0
+        # wakeup_fd becomes readable after output of any session, for
+        # frontends that wait on it together with their input
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.start()
 
+
+    def start(self):
+        # Session fds stay registered with the selector from proc_spawn to
+        # proc_waitfordeath
+        self.selector = selectors.DefaultSelector()
         # Supervisor thread
         self.signal_stop = 0
         self.thread = threading.Thread(target = self.proc_thread)
@@ -1255,6 +2340,53 @@ class Multiplexer(object):
         # Stop supervisor thread
         self.signal_stop = 1
         self.thread.join()
+        self.proc_close_wakeup()
+
+
+    def proc_wakeup(self):
+        # A full pipe has a wakeup pending already
+        try:
+            os.write(self.wakeup_write_fd, b'\0')
+        except (IOError, OSError):
+            pass
+
+
+    def proc_clear_wakeup(self):
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except (IOError, OSError):
+            pass
+
+
+    def proc_close_wakeup(self):
+        # Wakeups after stop fail on the invalid fds like on a full pipe
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            if fd >= 0:
+                os.close(fd)
+        self.wakeup_fd = self.wakeup_write_fd = -1
+
+
+    def proc_watch(self, sid, fd):
+        self.selector.register(fd, selectors.EVENT_READ, sid)
+
+
+    def proc_unwatch(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+
+    def proc_watch_write(self, sid, fd, pending):
+        # Wait for fd to become writable while input is pending
+        events = selectors.EVENT_READ
+        if pending:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(fd, events, sid)
+        except (KeyError, ValueError):
+            pass
 
 
 
@@ -1274,22 +2406,29 @@ class Multiplexer(object):
         self.session[sid]['h'] = h
 
 
-    @synchronized
-    def proc_keepalive(self, sid, w, h, cmd=None):
-        if not sid in self.session:
-            # Start a new session
-            self.session[sid] = {
-                'state':'unborn',
-                'term':	Terminal(w, h),
-                'time':	time.time(),
-                'w':	w,
-                'h':	h}
-            return self.proc_spawn(sid, cmd)
-        elif self.session[sid]['state'] == 'alive':
-            self.session[sid]['time'] = time.time()
+    def proc_keepalive(self, sid, w, h, cmd=None, engine=None):
+        with self.lock:
+            session = self.session.get(sid)
+            if session is None:
+                # Start a new session
+                term = terminal_class(engine or self.engine)(
+                    w, h, history_bytes=self.history_bytes,
+                    history_spill_bytes=self.history_spill_bytes,
+                    history_spill_dir=self.history_spill_dir)
+                self.session[sid] = {
+                    'state':'unborn',
+                    'term':	term,
+                    'lock':	threading.RLock(),
+                    'time':	time.time(),
+                    'w':	w,
+                    'h':	h}
+                return self.proc_spawn(sid, cmd)
+        if session['state'] == 'alive':
+            session['time'] = time.time()
             # Update terminal size
-            if self.session[sid]['w'] != w or self.session[sid]['h'] != h:
-                self.proc_resize(sid, w, h)
+            if session['w'] != w or session['h'] != h:
+                with session['lock']:
+                    self.proc_resize(sid, w, h)
             return True
         else:
             return False
@@ -1337,10 +2476,13 @@ class Multiplexer(object):
             fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
             # Set terminal size
             self.proc_resize(sid, w, h)
+            self.proc_watch(sid, fd)
             return True
 
 
     def proc_waitfordeath(self, sid):
+        if 'fd' in self.session.get(sid, {}):
+            self.proc_unwatch(self.session[sid]['fd'])
         try:
             os.close(self.session[sid]['fd'])
         except (KeyError, IOError, OSError):
@@ -1348,10 +2490,8 @@ class Multiplexer(object):
         if sid in self.session:
             if 'fd' in self.session[sid]:
                 del self.session[sid]['fd']
-        try:
-            os.waitpid(self.session[sid]['pid'], 0)
-        except (KeyError, IOError, OSError):
-            pass
+        if 'pid' in self.session.get(sid, {}):
+            self.proc_reap(self.session[sid]['pid'])
         if sid in self.session:
             if 'pid' in self.session[sid]:
                 del self.session[sid]['pid']
@@ -1359,25 +2499,40 @@ class Multiplexer(object):
         return True
 
 
+    def proc_reap(self, pid):
+        # Wait for the session process to exit
+        try:
+            os.waitpid(pid, 0)
+        except (IOError, OSError):
+            pass
+
+
     def proc_bury(self, sid):
-        if self.session[sid]['state'] == 'alive':
-            try:
-                os.kill(self.session[sid]['pid'], signal.SIGTERM)
-            except (IOError, OSError):
-                pass
-        self.proc_waitfordeath(sid)
-        if sid in self.session:
-            del self.session[sid]
+        with self.lock:
+            session = self.session.get(sid)
+        if session is None:
+            return False
+        with session['lock']:
+            if session['state'] == 'alive':
+                try:
+                    os.kill(session['pid'], signal.SIGTERM)
+                except (IOError, OSError):
+                    pass
+            self.proc_waitfordeath(sid)
+        with self.lock:
+            self.session.pop(sid, None)
+        session['term'].history.close()
         return True
 
 
-    @synchronized
     def proc_buryall(self):
-        for sid in list(self.session.keys()):
+        with self.lock:
+            sids = list(self.session.keys())
+        for sid in sids:
             self.proc_bury(sid)
 
 
-    @synchronized
+    @session_synchronized
     def proc_read(self, sid):
         """
         Read from process
@@ -1388,8 +2543,8 @@ class Multiplexer(object):
             return False
         try:
             fd = self.session[sid]['fd']
-            d = os.read(fd, 65536)
-            if not d:
+            n = os.readv(fd, [self.read_buffer])
+            if not n:
                 # Process finished, BSD
                 self.proc_waitfordeath(sid)
                 return False
@@ -1398,7 +2553,7 @@ class Multiplexer(object):
             self.proc_waitfordeath(sid)
             return False
         term = self.session[sid]['term']
-        term.write(d)
+        term.write(self.read_view[:n])
         # Read terminal response
         d = term.read()
         d = d.encode('utf-8')
@@ -1410,7 +2565,7 @@ class Multiplexer(object):
         return True
 
 
-    @synchronized
+    @session_synchronized
     def proc_write(self, sid, d):
         """
         Write to process
@@ -1419,47 +2574,115 @@ class Multiplexer(object):
             return False
         elif self.session[sid]['state'] != 'alive':
             return False
+        d = self.session[sid]['term'].pipe(d).encode("utf-8")
+        return self.proc_queue(sid, d)
+
+
+    @session_synchronized
+    def proc_write_raw(self, sid, d):
+        """
+        Write bytes to process as they are, without key translation
+        """
+        if sid not in self.session:
+            return False
+        elif self.session[sid]['state'] != 'alive':
+            return False
+        return self.proc_queue(sid, bytes(d))
+
+
+    def proc_queue(self, sid, d):
+        session = self.session[sid]
+        session['pending'] = session.get('pending', b'') + d
+        return self.proc_write_pending(sid)
+
+
+    @session_synchronized
+    def proc_flush(self, sid):
+        """
+        Write pending input to process
+        """
+        return self.proc_write_pending(sid)
+
+
+    def proc_write_pending(self, sid):
+        # Write what the process takes now, the rest waits until its fd is
+        # writable again
+        session = self.session.get(sid)
+        if session is None or session['state'] != 'alive':
+            return False
+        pending = session.get('pending')
+        if not pending:
+            return True
         try:
-            term = self.session[sid]['term']
-            d = term.pipe(d)
-            fd = self.session[sid]['fd']
-            os.write(fd, d.encode("utf-8"))
+            pending = pending[os.write(session['fd'], pending):]
+        except BlockingIOError:
+            pass
         except (IOError, OSError):
             return False
+        if bool(pending) != bool(session.get('writing')):
+            session['writing'] = bool(pending)
+            self.proc_watch_write(sid, session['fd'], pending)
+        session['pending'] = pending
         return True
 
 
-    @synchronized
+    # The dumps read the snapshot published by the last write and do not
+    # take the session lock
     def proc_dump(self, sid):
         """
         Dump terminal output
         """
-        if sid not in self.session:
+        session = self.session.get(sid)
+        if session is None:
             return False
-        return self.session[sid]['term'].dump()
+        return session['term'].dump()
+
+    def proc_dump_changes(self, sid, since_generation):
+        """
+        Dump the terminal rows changed after since_generation
+        """
+        session = self.session.get(sid)
+        if session is None:
+            return False
+        return session['term'].dump_changes(since_generation)
 
-    @synchronized
     def proc_dump_history(self, sid, scrollback):
-        term = self.session[sid]['term']
-        return term.dump(term.history.join_to_screen(term.screen,term.h, scrollback))
+        return self.session[sid]['term'].dump_history(scrollback)
+
+    def proc_generation(self, sid):
+        """
+        Generation of the published screen, it grows with every change
+        """
+        session = self.session.get(sid)
+        if session is None:
+            return None
+        return session['term'].snapshot.generation
+
+    @session_synchronized
+    def proc_history_lines(self, sid):
+        if sid not in self.session:
+            return 0
+        return len(self.session[sid]['term'].history)
+    
+    @session_synchronized
+    def proc_search(self, sid, query, regex=False, limit=1000):
+        """
+        Search the screen and the history of a session
+        """
+        if sid not in self.session:
+            return []
+        return self.session[sid]['term'].search(query, regex, limit)
     
-    @synchronized
-    def proc_getalive(self):
+    def proc_expire(self):
         """
-        Get alive sessions, bury timed out ones
+        Bury timed out sessions
         """
-        fds = []
-        fd2sid = {}
         now = time.time()
-        for sid in list(self.session.keys()):
-            then = self.session[sid]['time']
-            if (now - then) > self.timeout:
-                self.proc_bury(sid)
-            else:
-                if self.session[sid]['state'] == 'alive':
-                    fds.append(self.session[sid]['fd'])
-                    fd2sid[self.session[sid]['fd']] = sid
-        return (fds, fd2sid)
+        with self.lock:
+            expired = [sid for sid, session in self.session.items()
+                       if (now - session['time']) > self.timeout]
+        for sid in expired:
+            self.proc_bury(sid)
 
 
     def proc_thread(self):
@@ -1467,19 +2690,130 @@ class Multiplexer(object):
         Supervisor thread
         """
         while not self.signal_stop:
+            if time.time() >= self.expire_time:
+                self.proc_expire()
+                self.expire_time = time.time() + self.expire_interval
             # Read fds
-            (fds, fd2sid) = self.proc_getalive()
             try:
-                i, o, e = select.select(fds, [], [], 1.0)
+                events = self.selector.select(1.0)
             except (IOError, OSError):
-                i = []
-            for fd in i:
-                sid = fd2sid[fd]
-                self.proc_read(sid)
-                self.session[sid]["changed"] = time.time()
-            if len(i):
+                events = []
+            for key, mask in events:
+                sid = key.data
+                if mask & selectors.EVENT_WRITE:
+                    self.proc_flush(sid)
+                if mask & selectors.EVENT_READ:
+                    self.proc_read(sid)
+                    self.session.get(sid, {})["changed"] = time.time()
+            if events:
+                self.proc_wakeup()
                 time.sleep(0.002)
         self.proc_buryall()
+        self.selector.close()
+
+
+class AsyncMultiplexer(Multiplexer):
+    """
+    Multiplexer driven by an asyncio event loop instead of a supervisor
+    thread: session fds are watched with loop.add_reader and coroutines can
+    wait for a session to change. Its methods must be called from the loop.
+    """
+    def __init__(self, *args, loop=None, **kwargs):
+        self.loop = loop or asyncio.get_running_loop()
+        # Futures of proc_wait_changed calls by session
+        self.waiters = {}
+        self.expire_handle = None
+        Multiplexer.__init__(self, *args, **kwargs)
+
+
+    def start(self):
+        self.proc_expire_later()
+
+
+    def stop(self):
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        self.proc_buryall()
+        self.proc_close_wakeup()
+
+
+    def proc_watch(self, sid, fd):
+        self.loop.add_reader(fd, self.proc_ready, sid)
+
+
+    def proc_unwatch(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+
+    def proc_watch_write(self, sid, fd, pending):
+        if pending:
+            self.loop.add_writer(fd, self.proc_flush, sid)
+        else:
+            self.loop.remove_writer(fd)
+
+
+    def proc_expire_later(self):
+        self.proc_expire()
+        self.expire_handle = self.loop.call_later(self.expire_interval,
+                                                  self.proc_expire_later)
+
+
+    def proc_reap(self, pid, delay=0.01):
+        # The process may take a while to exit, poll for it without
+        # blocking the loop
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                self.loop.call_later(delay, self.proc_reap, pid,
+                                     min(2 * delay, 1.0))
+        except (IOError, OSError):
+            pass
+
+
+    def proc_ready(self, sid):
+        """
+        Read from a process whose fd is readable
+        """
+        alive = self.proc_read(sid)
+        session = self.session.get(sid)
+        if session is not None:
+            session["changed"] = time.time()
+        self.proc_notify(sid, alive)
+        self.proc_wakeup()
+
+
+    def proc_notify(self, sid, result):
+        for waiter in self.waiters.pop(sid, ()):
+            if not waiter.done():
+                waiter.set_result(result)
+
+
+    def proc_bury(self, sid):
+        result = Multiplexer.proc_bury(self, sid)
+        self.proc_notify(sid, False)
+        return result
+
+
+    async def proc_wait_changed(self, sid, timeout=None):
+        """
+        Wait for output of a session, False if it ended or on timeout
+        """
+        if self.session.get(sid, {}).get('state') != 'alive':
+            return False
+        waiter = self.loop.create_future()
+        waiters = self.waiters.setdefault(sid, [])
+        waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # proc_notify drops the list of the waiters it wakes up
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters and self.waiters.get(sid) is waiters:
+                    del self.waiters[sid]
 
 
 def ssh_command(login, executable="ssh"):
@@ -1493,21 +2827,24 @@ def ssh_command(login, executable="ssh"):
 
 class Session(object):
     _mux = None
+    mux_class = Multiplexer
 
     @classmethod
     def close_all(cls):
-        Session._mux.stop()
+        cls._mux.stop()
 
 
-    def __init__(self, cmd=None, width=80, height=24):
-        if not Session._mux:
+    def __init__(self, cmd=None, width=80, height=24, engine=None):
+        cls = type(self)
+        if not cls._mux:
             if cmd != None:
-                Session._mux = Multiplexer(cmd=cmd)
+                cls._mux = cls.mux_class(cmd=cmd)
             else:
-                Session._mux = Multiplexer()
+                cls._mux = cls.mux_class()
         self._session_id = "%s-%s" % (time.time(), id(self))
         self._width = width
         self._height = height
+        self._engine = engine
         self._started = False
 
 
@@ -1519,45 +2856,101 @@ class Session(object):
 
 
     def start(self, cmd=None):
-        self._started = Session._mux.proc_keepalive(
-            self._session_id, self._width, self._height, cmd or self.cmd)
+        self._started = self._mux.proc_keepalive(
+            self._session_id, self._width, self._height, cmd or self.cmd,
+            self._engine)
         return self._started
 
 
     def close(self):
-        return Session._mux.proc_bury(self._session_id)
+        return self._mux.proc_bury(self._session_id)
 
     
     stop = close
 
 
     def is_alive(self):
-        return Session._mux.session.get(self._session_id, {}).get('state') == 'alive'
+        return self._mux.session.get(self._session_id, {}).get('state') == 'alive'
 
         
     def keepalive(self):
-        return Session._mux.proc_keepalive(self._session_id, self._width, self._height)
+        return self._mux.proc_keepalive(self._session_id, self._width,
+                                           self._height, engine=self._engine)
 
 
     def dump(self):
         if self.keepalive():
-            return Session._mux.proc_dump(self._session_id)
+            return self._mux.proc_dump(self._session_id)
+
+    def dump_changes(self, since_generation=0):
+        if self.keepalive():
+            return self._mux.proc_dump_changes(self._session_id, since_generation)
 
     def dump_history(self, scrollback):
         if self.keepalive():
-            return Session._mux.proc_dump_history(self._session_id, scrollback)
+            return self._mux.proc_dump_history(self._session_id, scrollback)
+
+    def history_lines(self):
+        return self._mux.proc_history_lines(self._session_id)
+
+    def generation(self):
+        return self._mux.proc_generation(self._session_id)
+
+    def wakeup_fd(self):
+        return self._mux.wakeup_fd
+
+    def clear_wakeup(self):
+        self._mux.proc_clear_wakeup()
+
+    def search(self, query, regex=False, limit=1000):
+        return self._mux.proc_search(self._session_id, query, regex, limit)
 
     def write(self, data):
         if self.keepalive():
-            Session._mux.proc_write(self._session_id, data)
+            self._mux.proc_write(self._session_id, data)
+
+    def write_raw(self, data):
+        if self.keepalive():
+            self._mux.proc_write_raw(self._session_id, data)
 
 
     def last_change(self):
-        return Session._mux.session.get(self._session_id, {}).get("changed", None)
+        return self._mux.session.get(self._session_id, {}).get("changed", None)
 
     
     def pid(self):
-        return Session._mux.session.get(self._session_id, {}).get("pid", None)
+        return self._mux.session.get(self._session_id, {}).get("pid", None)
+
+
+class AsyncSession(Session):
+    # Session on an AsyncMultiplexer, create it from a coroutine
+    _mux = None
+    mux_class = AsyncMultiplexer
+
+    async def write(self, data):
+        Session.write(self, data)
+
+
+    async def write_raw(self, data):
+        Session.write_raw(self, data)
+
+
+    async def dump(self):
+        return Session.dump(self)
+
+
+    async def wait_changed(self, timeout=None):
+        if self.keepalive():
+            return await self._mux.proc_wait_changed(self._session_id,
+                                                     timeout)
+        return False
+
+
+    async def close(self):
+        return Session.close(self)
+
+
+    stop = close
 
 
 
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+import collections
 import curses
+import selectors
 import sys
 import os
 
 from signal import signal, SIGTSTP, SIGINT
-from time import sleep, time
+from time import time
+import backend
 from backend import Session
+from charwidth import text_width
 from procinfo import ProcessInfo
 
 proc_info = ProcessInfo()
@@ -32,6 +36,93 @@ def get_title(pid, focus=False):
     else:
         return cmd
 
+class ColorPairs(object):
+    """Curses attributes for the styles of dumped runs
+
+    Color pairs are defined when a (fg, bg) combination is first drawn and
+    reused afterwards. Once all pairs are taken the least recently used one
+    is redefined, which recolors the cells already drawn with it, so the
+    windows repaint themselves when evictions changes. Colors the terminal
+    lacks are approximated with the nearest palette color.
+    """
+    flag_attrs = [
+        (backend.STYLE_BOLD, curses.A_BOLD),
+        (backend.STYLE_FAINT, curses.A_DIM),
+        (backend.STYLE_ITALIC, getattr(curses, 'A_ITALIC', 0)),
+        (backend.STYLE_UNDERLINE, curses.A_UNDERLINE),
+        (backend.STYLE_BLINK, curses.A_BLINK),
+        (backend.STYLE_INVERSE, curses.A_REVERSE),
+        (backend.STYLE_CONCEAL, curses.A_INVIS),
+    ]
+
+    def __init__(self):
+        self.enabled = curses.has_colors()
+        self.colors = curses.COLORS if self.enabled else 0
+        # Pair 0 is the default colors and cannot be changed, attributes
+        # hold pair numbers up to 255
+        self.max_pairs = min(curses.COLOR_PAIRS, 256) - 1 if self.enabled else 0
+        try:
+            curses.use_default_colors()
+            self.default = -1
+        except curses.error:
+            self.default = 0
+        # Pair numbers by (fg, bg), least recently used first
+        self.pairs = collections.OrderedDict()
+        # Number of pairs redefined
+        self.evictions = 0
+        # Curses colors and attributes by style
+        self.styles = {}
+        self.color_cache = {}
+
+    def color(self, color):
+        # Curses color for a color of a dumped style
+        if color is None:
+            return self.default
+        try:
+            return self.color_cache[color]
+        except KeyError:
+            pass
+        if isinstance(color, int) and color < self.colors:
+            result = color
+        else:
+            result = min(range(min(self.colors, 256)),
+                         key=lambda i: backend.color_distance(color, i))
+        self.color_cache[color] = result
+        return result
+
+    def pair(self, fg, bg):
+        key = (fg, bg)
+        try:
+            self.pairs.move_to_end(key)
+            return self.pairs[key]
+        except KeyError:
+            pass
+        if len(self.pairs) < self.max_pairs:
+            pair = len(self.pairs) + 1
+        else:
+            pair = self.pairs.popitem(last=False)[1]
+            self.evictions += 1
+        curses.init_pair(pair, fg, bg)
+        self.pairs[key] = pair
+        return pair
+
+    def attr(self, style):
+        try:
+            fg, bg, attr = self.styles[style]
+        except KeyError:
+            attr = 0
+            for flag, flag_attr in self.flag_attrs:
+                if style.flags & flag:
+                    attr |= flag_attr
+            fg, bg = -1, -1
+            if self.enabled:
+                fg, bg = self.color(style.fg), self.color(style.bg)
+            self.styles[style] = fg, bg, attr
+        if fg == bg == self.default or not self.enabled:
+            return attr
+        return attr | curses.color_pair(self.pair(fg, bg))
+
+
 class Terminal(object):
     keymap = {
             'SIGTSTP' : b'\x1a',
@@ -63,7 +154,7 @@ class Terminal(object):
             curses.KEY_UP : b'~A',
     }
  
-    def __init__(self, parent_window, width=None, height=None, top=0, left=0):
+    def __init__(self, parent_window, colors, width=None, height=None, top=0, left=0):
         h, w = parent_window.getmaxyx()
         if not width:
             width = w
@@ -78,60 +169,179 @@ class Terminal(object):
         self.session = Session(width=self.width, height = self.height)
         self.pid = self.session.pid
         self._window = win
+        self.colors = colors
 
         self.scrollback = 0
         self.last_scrollback = 0
         self.last_scroll_screen = None
+        # Screen generation and scrollback of the last refresh
+        self.drawn = None
+        # Text and the attribute of every character of the rows in the
+        # window, by row number
+        self.rows = {}
+        # Screen generation of the rows in the window
+        self.generation = 0
+        # Color pair evictions seen by the last full repaint
+        self.evictions = colors.evictions
 
     def get_input(self):
-        inp = self._window.getch()
-        return inp
-
-    def send_key(self, key):
+        # All pending keys
+        keys = []
+        while True:
+            inp = self._window.getch()
+            if inp == -1:
+                return keys
+            keys.append(inp)
+
+    def translate_key(self, key):
+        # Bytes to send for a key, None for keys handled here
         if key == -1:
-            return
+            return None
         elif key in self.keymap:
-            c_char = self.keymap[key]
+            return self.keymap[key]
         elif key == curses.KEY_SPREVIOUS:
-            self.scrollback += 5
-            return
+            self.scrollback = min(self.scrollback + 5,
+                                  self.session.history_lines())
+            return None
         elif key == curses.KEY_SNEXT:
             self.scrollback -= 5
             if self.scrollback < 0:
                 self.scrollback = 0
-            return
+            return None
         else:
-            c_char = chr(key).encode('utf-8')
-
-        self.session.write(c_char)
+            return chr(key).encode('utf-8')
+
+    def send_keys(self, keys):
+        # Send keys to the session in one write
+        data = []
+        for key in keys:
+            c_char = self.translate_key(key)
+            if c_char:
+                data.append(c_char)
+        if data:
+            self.session.write(b''.join(data))
 
-    def get_cursorscreen(self):
+    def send_key(self, key):
+        self.send_keys([key])
+
+    def search(self, query, regex=False):
+        # scroll back to the next match above the current view
+        for scrollback, y, x in self.session.search(query, regex):
+            if scrollback > self.scrollback:
+                self.scrollback = scrollback
+                return True
+        return False
+
+    def changed(self):
+        return (self.drawn != (self.session.generation(), self.scrollback) or
+                self.evictions != self.colors.evictions)
+
+    def redraw(self):
+        # Repaint the whole window on the next refresh
+        self._window.touchwin()
+        self.drawn = None
+
+    def get_changes(self):
+        # Cursor and the lines that may differ from the window, by row
         if self.scrollback == 0:
+            since = self.generation if self.last_scrollback == 0 else 0
+            changes = self.session.dump_changes(since)
+            if not changes:
+                return None, {}
+            cursor, self.generation, lines = changes
             self.last_scrollback = 0
-            return self.session.dump()
+            return cursor, lines
         else:
             if self.scrollback != self.last_scrollback:
                 self.last_scroll_screen = self.session.dump_history(self.scrollback)
                 self.last_scrollback = self.scrollback
-            return self.last_scroll_screen
-        
-    def refresh(self):
-        (cx, cy), screen = self.get_cursorscreen()
+                cursor, screen = self.last_scroll_screen
+                return cursor, dict(enumerate(screen))
+            return self.last_scroll_screen[0], {}
 
-        # write the current screen to the window
-        self._window.erase()
-        for line_nr, line in enumerate(screen):
-            text = ''
-            for element in line:
-                if type(element) == str:
-                    text += element
-            self._window.addstr(line_nr, 0, text)
+    def get_screen(self):
+        # Cursor and all lines of the view
+        if self.scrollback == 0:
+            changes = self.session.dump_changes(0)
+            if not changes:
+                return None, {}
+            cursor, self.generation, lines = changes
+            return cursor, lines
+        cursor, screen = self.last_scroll_screen
+        return cursor, dict(enumerate(screen))
+
+    def draw_row(self, y, runs):
+        # Write the part of row y that differs from what the window shows,
+        # runs are (text, attr) pairs
+        text = ''.join(run for run, attr in runs)
+        attrs = [attr for run, attr in runs for c in run]
+        old = self.rows.get(y)
+        if old == (text, attrs):
+            return
+        self.rows[y] = (text, attrs)
+        if old is None:
+            self.draw_span(y, runs, 0, len(text))
+            self._window.clrtoeol()
+            return
+        old_text, old_attrs = old
+        n = min(len(old_text), len(text))
+        start = 0
+        while (start < n and old_text[start] == text[start] and
+               old_attrs[start] == attrs[start]):
+            start += 1
+        end = 0
+        while (end < n - start and old_text[-1 - end] == text[-1 - end] and
+               old_attrs[-1 - end] == attrs[-1 - end]):
+            end += 1
+        if text_width(old_text[start:len(old_text) - end]) == text_width(text[start:len(text) - end]):
+            self.draw_span(y, runs, start, len(text) - end)
+        else:
+            # The rest of the row moved
+            self.draw_span(y, runs, start, len(text))
+            self._window.clrtoeol()
+
+    def draw_span(self, y, runs, start, end):
+        # Write characters start to end of a row
+        self._window.move(y, text_width(''.join(run for run, attr in runs)[:start]))
+        x = 0
+        for run, attr in runs:
+            if x + len(run) > start and x < end:
+                self._window.addstr(run[max(start - x, 0):end - x], attr)
+            x += len(run)
+
+    def refresh(self):
+        self.drawn = (self.session.generation(), self.scrollback)
+        cursor, lines = self.get_changes()
+        self.draw_lines(lines)
+        if self.evictions != self.colors.evictions:
+            # Pairs of rows drawn before were redefined, repaint them all.
+            # A frame with more colors than pairs is repainted only once.
+            self.rows.clear()
+            cursor, lines = self.get_screen()
+            self.draw_lines(lines)
+            self.evictions = self.colors.evictions
+        if cursor is None:
+            return
+        cx, cy = cursor
 
         # move to currents sessions cursor pos:
         if cy != None:
             self._window.move(cy, cx)
         
         self._window.refresh()
+
+    def draw_lines(self, lines):
+        # write dumped lines to the window, by row number
+        for line_nr in sorted(lines):
+            runs = []
+            attr = 0
+            for element in lines[line_nr]:
+                if type(element) == str:
+                    if element:
+                        runs.append((element, attr))
+                else:
+                    attr = self.colors.attr(element)
+            self.draw_row(line_nr, runs)
         
     def is_alive(self):
         return self.session.is_alive()
@@ -147,12 +357,16 @@ class Terminal(object):
 
 
 class StatusBar(object):
-    def __init__(self, width, top, left):
+    style = backend.DumpStyle(curses.COLOR_WHITE, curses.COLOR_RED, False, 0, False)
+
+    def __init__(self, width, top, left, colors):
         height = 2
         self.width = width
+        self.colors = colors
         self._window = curses.newwin(height, width, top, left)
         self.text = ''
         self.focused_pid = 0
+        self.evictions = colors.evictions
 
     def set_focus(self, terminal):
         self.fucused_pid = terminal.pid
@@ -163,29 +377,86 @@ class StatusBar(object):
     def add_terminal(self, pid):
         self.text += '[{}]'.format(get_title(pid, pid==self.fucused_pid))
 
+    def changed(self):
+        return self.evictions != self.colors.evictions
+
     def refresh(self):
+        self.evictions = self.colors.evictions
         text = (self.text+self.width*' ')[:self.width]
-        self._window.addstr(0, 0, text, curses.color_pair(1))
+        self._window.addstr(0, 0, text, self.colors.attr(self.style))
         self._window.refresh()
 
 
 class TerminalContainer(object):
-    def __init__(self, window):
+    # Refreshes are at least min_frame seconds apart. The gap grows up to
+    # max_frame while output keeps coming without input or when refreshes
+    # take long.
+    min_frame = 1/60
+    max_frame = 1/15
+    # The status bar is refreshed every status_interval seconds
+    status_interval = 2
+    # In raw mode the bytes typed are passed on unchanged, except for the
+    # prefix key (Ctrl-A) and the binding key that follows it
+    prefix = b'\x01'
+
+    def __init__(self, window, raw=False):
         self._window = window
         self.height, self.width = window.getmaxyx()
         self.terminals = []
         self.focused = None
+        self.colors = ColorPairs()
         self.add_terminal()
-        self.statusbar = StatusBar(self.width, self.height-1, 0)
+        self.statusbar = StatusBar(self.width, self.height-1, 0, self.colors)
         self.refreshs = 0
+        self.frame = self.min_frame
+        self.raw = raw
+        self.prefix_pending = False
+        self.bindings = {
+            b'a': lambda: self.focused.session.write_raw(self.prefix),
+            b'c': self.add_terminal,
+            b'n': lambda: self.focus_terminal(0, 1),
+            b'p': lambda: self.focus_terminal(0, -1),
+            b'[': lambda: self.focused.send_key(curses.KEY_SPREVIOUS),
+            b']': lambda: self.focused.send_key(curses.KEY_SNEXT),
+            b'/': self.search,
+        }
+        if raw:
+            # Ctrl-C, Ctrl-Z and flow control keys are input too, cursor
+            # keys come in the normal mode sequences
+            curses.raw()
+            window.keypad(False)
         print('Container created!')
 
     def add_terminal(self):
-        new_term = Terminal(self._window)
+        new_term = Terminal(self._window, self.colors)
         self.terminals.append(new_term)
         self.focused = new_term
         self.focused.run()
 
+    def read_raw(self):
+        # Bytes typed, read from the tty in one go
+        return os.read(sys.stdin.fileno(), 65536)
+
+    def send_raw(self, data):
+        # Pass data on to the focused terminal, run prefix bindings
+        i = 0
+        while i < len(data):
+            if self.prefix_pending:
+                self.prefix_pending = False
+                binding = self.bindings.get(data[i:i + 1])
+                i += 1
+                if binding:
+                    binding()
+                continue
+            j = data.find(self.prefix, i)
+            if j < 0:
+                j = len(data)
+            else:
+                self.prefix_pending = True
+            if j > i:
+                self.focused.session.write_raw(data[i:j])
+            i = j + 1
+
     def get_input(self):
         return self.focused.get_input()
     
@@ -200,6 +471,7 @@ class TerminalContainer(object):
             self.terminals.remove(self.focused)
             if self.terminals:
                 self.focused = self.terminals[0]
+                self.focused.redraw()
                 return self.is_alive()
             else:
                 return False
@@ -217,10 +489,23 @@ class TerminalContainer(object):
             index = current_index + relative
         index = index % len(self.terminals)
         self.focused = self.terminals[index]
+        self.focused.redraw()
 
     def has_focus(self, terminal):
         return terminal is self.focused
 
+    def search(self):
+        # Scroll the focused terminal back to the next match of the text
+        # asked for on the status line
+        y = self.height - 1
+        self._window.move(y, 0)
+        self._window.clrtoeol()
+        query = self.input(y, 0, 'search: ').decode('utf-8', 'replace')
+        if query:
+            self.focused.search(query)
+        self.focused.redraw()
+        self.statusbar.refresh()
+
     def input(self, y, x, prompt, attr=0):
         self._window.nodelay(False)
         curses.echo()
@@ -232,30 +517,54 @@ class TerminalContainer(object):
 
     def run(self):
         print('run Container... ')
+        # Wait for keys and for output of the sessions, refresh only when
+        # the focused terminal changed
+        selector = selectors.DefaultSelector()
+        selector.register(sys.stdin.fileno(), selectors.EVENT_READ, 'input')
+        selector.register(self.focused.session.wakeup_fd(),
+                          selectors.EVENT_READ)
+        last_refresh = last_status = 0
+        timeout = 0
         while self.is_alive():
-            t1 = time()
-            self.refreshs += 1
+            events = selector.select(timeout)
+            self.focused.session.clear_wakeup()
+            if self.raw:
+                keys = b''
+                if any(key.data == 'input' for key, mask in events):
+                    keys = self.read_raw()
+                    self.send_raw(keys)
+            else:
+                keys = self.focused.get_input()
+                self.focused.send_keys(keys)
 
-            if not self.refreshs % 60:
+            now = time()
+            if now - last_status >= self.status_interval:
                 self.statusbar.refresh()
-            inp = self.focused.get_input()
-            self.focused.send_key(inp)
-            self.focused.refresh()
-                        
-            # reduce cpu-percentage:
-            sleeptime = (1/30) - (time()-t1)
-            if sleeptime > 0:
-                sleep(sleeptime)
+                last_status = now
+            timeout = self.status_interval
+            if self.focused.changed():
+                wait = last_refresh + self.frame - now
+                if not keys and wait > 0:
+                    timeout = min(timeout, wait)
+                else:
+                    streaming = not keys and wait > -self.frame
+                    self.focused.refresh()
+                    if self.statusbar.changed():
+                        self.statusbar.refresh()
+                    self.refreshs += 1
+                    last_refresh = time()
+                    frame = 2 * (last_refresh - now)
+                    if streaming:
+                        frame = max(frame, 1.5 * self.frame)
+                    self.frame = min(max(frame, self.min_frame),
+                                     self.max_frame)
         
 if __name__ == '__main__':
     def main(stdscr):
         try:
-            # init colors:
-            curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_RED)
-    
             # create terminal:
             win = curses.newwin(100, 100, 0, 0)
-            master = TerminalContainer(stdscr)
+            master = TerminalContainer(stdscr, raw='-r' in sys.argv[1:])
 
             # bin signals:
             signal(SIGINT, master.signal_handler)
@@ -0,0 +1,79 @@
+import array
+import threading
+import unittest
+
+import backend
+
+
+class SGRTest(unittest.TestCase):
+    def style_of(self, data, char):
+        # Style of the run holding char in the first dumped row
+        t = backend.Terminal(20, 3)
+        t.write(data)
+        line = t.dump()[1][0]
+        for i in range(2, len(line), 3):
+            if char in line[i]:
+                return line[i - 1]
+
+    def test_private_sequences_are_ignored(self):
+        # xterm's modifyOtherKeys, sent by vim on startup
+        for seq in (b'\x1b[>4;2m', b'\x1b[>4;m'):
+            style = self.style_of(b'\x1b[31mA' + seq + b'B', 'B')
+            self.assertEqual((style.fg, style.flags), (1, 0))
+
+
+class DumpTest(unittest.TestCase):
+    def assert_layout(self, line):
+        # ["", style, text] triples
+        self.assertEqual(len(line) % 3, 0)
+        for i in range(0, len(line), 3):
+            self.assertEqual(line[i], "")
+            self.assertIsInstance(line[i + 1], backend.DumpStyle)
+            self.assertIsInstance(line[i + 2], str)
+
+    def test_cursor_past_the_first_run(self):
+        t = backend.Terminal(30, 2)
+        t.write(b'\x1b[91;104mF\x1b[0mGH\x1b[D')
+        line = t.dump()[1][0]
+        self.assert_layout(line)
+        texts = [(line[i + 1].cursor, line[i + 2])
+                 for i in range(0, len(line), 3)]
+        self.assertEqual(texts[:4], [(False, 'F'), (False, 'G'),
+                                     (True, 'H'), (False, ' ' * 27)])
+
+    def test_cursor_in_the_first_run(self):
+        t = backend.Terminal(30, 2)
+        t.write(b'AB\x1b[D')
+        self.assert_layout(t.dump()[1][0])
+
+
+class HistoryTest(unittest.TestCase):
+    def rows(self, n, char):
+        return [array.array('I', [ord(char)] * 80) for i in range(n)]
+
+    def test_total_budget_takes_one_lock_at_a_time(self):
+        budget = backend.History.max_total_bytes
+        self.addCleanup(backend.History.set_total_budget, budget)
+        large = backend.History(segment_lines=16)
+        large.write_lines(self.rows(1000, 'a'))
+        small = backend.History(segment_lines=16)
+        backend.History.set_total_budget(large.nbytes())
+        with large.lock:
+            # The writer waits for large.lock to evict from it, without
+            # holding its own
+            writer = threading.Thread(
+                target=small.write_lines, args=(self.rows(32, 'b'),),
+                daemon=True)
+            writer.start()
+            while small.written < 32:
+                writer.join(0.01)
+            self.assertTrue(small.lock.acquire(timeout=5))
+            small.lock.release()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertLessEqual(backend.History.total_bytes(),
+                             backend.History.max_total_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import curses
+import unittest
+from unittest import mock
+
+import backend
+import frontend
+
+
+class Window(object):
+    # Characters and attributes written, by row
+    def __init__(self, w, h):
+        self.cells = [[(' ', 0)] * w for y in range(h)]
+        self.y = self.x = 0
+
+    def move(self, y, x):
+        self.y, self.x = y, x
+
+    def addstr(self, text, attr=0):
+        for c in text:
+            self.cells[self.y][self.x] = (c, attr)
+            self.x += 1
+
+    def clrtoeol(self):
+        row = self.cells[self.y]
+        row[self.x:] = [(' ', 0)] * (len(row) - self.x)
+
+    def refresh(self):
+        pass
+
+
+class Session(object):
+    # Dumped lines with a generation each
+    def __init__(self):
+        self.lines = {}
+        self.gen = 0
+
+    def set_line(self, y, line):
+        self.gen += 1
+        self.lines[y] = (self.gen, line)
+
+    def generation(self):
+        return self.gen
+
+    def dump_changes(self, since_generation):
+        lines = dict((y, line) for y, (gen, line) in self.lines.items()
+                     if gen > since_generation)
+        return (0, 0), self.gen, lines
+
+
+class ColorPairsTest(unittest.TestCase):
+    def setUp(self):
+        self.defined = {}
+        patches = [
+            mock.patch('curses.has_colors', return_value=True),
+            mock.patch('curses.COLORS', 256, create=True),
+            mock.patch('curses.COLOR_PAIRS', 4, create=True),
+            mock.patch('curses.use_default_colors'),
+            mock.patch('curses.init_pair', self.init_pair),
+            mock.patch('curses.color_pair', lambda pair: pair << 8),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.colors = frontend.ColorPairs()
+        self.terminal = frontend.Terminal.__new__(frontend.Terminal)
+        self.terminal.__dict__.update(
+            session=Session(), _window=Window(10, 3), colors=self.colors,
+            scrollback=0, last_scrollback=0, drawn=None, rows={},
+            generation=0, evictions=self.colors.evictions)
+
+    def init_pair(self, pair, fg, bg):
+        self.defined[pair] = (fg, bg)
+
+    def style(self, fg):
+        return backend.DumpStyle(fg, None, False, 0, False)
+
+    def shown_colors(self, y):
+        # (fg, bg) of the pair of every character of row y
+        return [self.defined[attr >> 8] for c, attr in
+                self.terminal._window.cells[y] if c != ' ']
+
+    def test_evicted_pairs_are_repainted(self):
+        session = self.terminal.session
+        session.set_line(0, ['', self.style(1), 'aa'])
+        session.set_line(1, ['', self.style(2), 'bb'])
+        self.terminal.refresh()
+        # Three pairs fit, the pair of row 0 is the least recently used
+        session.set_line(1, ['', self.style(3), 'c', '', self.style(4), 'd'])
+        self.assertTrue(self.terminal.changed())
+        self.terminal.refresh()
+        self.assertEqual(self.shown_colors(0), [(1, -1)] * 2)
+        self.assertEqual(self.shown_colors(1), [(3, -1), (4, -1)])
+        self.assertFalse(self.terminal.changed())
+
+
+if __name__ == '__main__':
+    unittest.main()